@@ -5,10 +5,27 @@
 #     US Gov Food Search Site:  https://ndb.nal.usda.gov/ndb/search/list
 #     UPC Database Lookup Site: https://www.upcitemdb.com
 
+import bisect
+import collections
+import concurrent.futures
+import csv
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import numpy
 import os
 import pickle
-import usda
-from usda.client import UsdaClient
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
 
 # Conversion coefficients to ml:
 VOLUME_CONVERSIONS = {
@@ -31,13 +48,244 @@ MASS_CONVERSIONS = {
   "onz": 28.349523,
 }
 
+# The nutrient fields of a *Food* in the order that they are stored in *Food.nutrients*:
+NUTRIENT_NAMES = (
+  "calories",       # The energy per 100 grams (kcal)
+  "total_fat",      # The total fat per 100 grams (g)
+  "saturated_fat",  # The staturated fat per 100 grams (g)
+  "trans_fat",      # The tran fat per 100 grams (g)
+  "cholesterol",    # The cholesterol per 100 grams (mg)
+  "sodium",         # The sodium per 100 grams (mg)
+  "carbohydrates",  # The total carbohydrates per 100 grams (g)
+  "dietary_fiber",  # The dietary fiber per 100 grams (g)
+  "sugars",         # The surgars per 100 grams (g)
+  "protein",        # The protein per 100 grams (g)
+  "calcium",        # The calcium per 100 grams (mg)
+  "potassium",      # The potassium per 100 grams (g)
+)
+NUTRIENTS_SIZE = len(NUTRIENT_NAMES)
+
+# Reference amounts (roughly the US daily values) used to put each of the *NUTRIENT_NAMES* on
+# a common scale when comparing the nutrient profiles of foods:
+NUTRIENT_REFERENCES = numpy.array([
+  2000.0,  # calories (kcal)
+    78.0,  # total_fat (g)
+    20.0,  # saturated_fat (g)
+     2.0,  # trans_fat (g)
+   300.0,  # cholesterol (mg)
+  2300.0,  # sodium (mg)
+   275.0,  # carbohydrates (g)
+    28.0,  # dietary_fiber (g)
+    50.0,  # sugars (g)
+    50.0,  # protein (g)
+  1300.0,  # calcium (mg)
+  4700.0,  # potassium (mg)
+], dtype=numpy.float64)
+
+# The default location of the persistent *FoodStore*:
+FOOD_STORE_PATH = "/tmp/food_tools.sqlite3"
+
+# The default number of seconds after which a stored USDA food is revalidated:
+FOOD_STORE_MAX_AGE = 30.0 * 24.0 * 3600.0
+
+# The version of the USDA data returned by *Food.usda_fetch*.  Stored foods fetched from any
+# other version are stale and get revalidated (see *FoodStore.refresh*):
+USDA_SOURCE_VERSION = "ndb-sr28"
+
+# The source of foods that did not come from the USDA (e.g. inline foods); these are never
+# revalidated:
+INLINE_SOURCE = "inline"
+
+# The default location of the offline *FoodCatalog* directory:
+FOOD_CATALOG_PATH = "/tmp/food_tools.catalog"
+
+# The default location of the persisted *FoodSearchIndex*:
+FOOD_SEARCH_INDEX_PATH = "/tmp/food_tools.search"
+
+# USDA FoodData Central nutrient numbers for each of the *NUTRIENT_NAMES*:
+USDA_NUTRIENT_NUMBERS = {
+  208.0: "calories",
+  204.0: "total_fat",
+  606.0: "saturated_fat",
+  605.0: "trans_fat",
+  601.0: "cholesterol",
+  307.0: "sodium",
+  205.0: "carbohydrates",
+  291.0: "dietary_fiber",
+  269.0: "sugars",
+  203.0: "protein",
+  301.0: "calcium",
+  306.0: "potassium",
+}
+
+# Longer unit names used in USDA serving measures mapped to the names used here:
+UNIT_ALIASES = {
+  "cups":        "cup",
+  "fl":          "floz",
+  "gram":        "g",
+  "grams":       "g",
+  "liter":       "litre",
+  "ounce":       "oz",
+  "ounces":      "oz",
+  "pints":       "pint",
+  "quarts":      "quart",
+  "tablespoon":  "tbsp",
+  "tablespoons": "tbsp",
+  "teaspoon":    "tsp",
+  "teaspoons":   "tsp",
+}
+
+# The structured results of processing a recipe.  *nutrients* are numpy vectors in
+# *NUTRIENT_NAMES* order for the (scaled) ingredient or recipe, rather than per 100 grams:
+IngredientReport = collections.namedtuple("IngredientReport",
+  ["index", "amount", "units", "description", "grams", "total_grams", "nutrients"])
+RecipeReport = collections.namedtuple("RecipeReport",
+  ["name", "scale", "ingredients", "grams", "nutrients"])
+
+def upc_normalize(upc):
+    # Verify argument types:
+    assert isinstance(upc, str)
+
+    # Return *upc* as a 13 digit EAN-13 code.  A 12 digit UPC-A code gets a leading zero and
+    # a 14 digit GTIN loses its leading zero, so that every spelling of a code is one key:
+    digits = "".join(character for character in upc if character.isdigit())
+    assert 0 < len(digits) <= 14, "Bad UPC '{0}'".format(upc)
+    if len(digits) == 14 and digits[0] == "0":
+        digits = digits[1:]
+    return digits.zfill(13)
+
+def food_source_check(client):
+    # Return *True* if foods can be fetched from the data source *client* (see *Food.fetch*).
+    # That is any object with a `food_fetch(food_id)` method that returns a *Food*, or a
+    # `usda.client.UsdaClient` (anything with its `search_foods` and `get_food_report`):
+    return hasattr(client, "food_fetch") or \
+      (hasattr(client, "search_foods") and hasattr(client, "get_food_report"))
+
+def usda_client_create(api_key):
+    # Return a new `usda.client.UsdaClient`.  `usda` (and `requests`) are only imported here,
+    # so that anything that never talks to the USDA does not pay for (or need) them:
+    from usda.client import UsdaClient
+
+    return UsdaClient(api_key)
+
+def units_normalize(label):
+    # Verify argument types:
+    assert isinstance(label, str)
+
+    # Sometimes *label* has some extra information (e.g. "cup, chopped")... Trim it off:
+    units = label.strip().lower()
+    space_index = units.find(' ')
+    if space_index >=0:
+        units = units[:space_index]
+    units = units.rstrip(",")
+    return UNIT_ALIASES.get(units, units)
+
+class BufferedRenderer:
+    # The number of characters buffered before they are written to the stream:
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, stream=None):
+        # Verify argument types:
+        assert stream is None or hasattr(stream, "write")
+
+        # Load up *renderer* (i.e. *self*).  Nothing reaches *stream* until *BUFFER_SIZE*
+        # characters have accumulated or *flush*() is called:
+        renderer = self
+        renderer.stream = sys.stdout if stream is None else stream
+        renderer.buffer = io.StringIO()
+
+    def write(self, text):
+        renderer = self
+        buffer = renderer.buffer
+        buffer.write(text)
+        if buffer.tell() >= BufferedRenderer.BUFFER_SIZE:
+            renderer.flush()
+
+    def flush(self):
+        renderer = self
+        buffer = renderer.buffer
+        if buffer.tell() > 0:
+            renderer.stream.write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+        renderer.stream.flush()
+
+    def recipe(self, report):
+        assert False, "{0} does not render recipes".format(type(self).__name__)
+
+    def food(self, food, heading=None):
+        assert False, "{0} does not render foods".format(type(self).__name__)
+
+    def error(self, message, heading=None):
+        assert False, "{0} does not render errors".format(type(self).__name__)
+
+class CsvRenderer(BufferedRenderer):
+    def __init__(self, stream=None, header=True):
+        # Verify argument types:
+        assert isinstance(header, bool)
+
+        # One row per ingredient and one "Total" row per recipe, all under a single header:
+        BufferedRenderer.__init__(self, stream)
+        renderer = self
+        renderer.writer = csv.writer(renderer.buffer, lineterminator="\n")
+        if header:
+            renderer.writer.writerow(
+              ("recipe", "scale", "index", "amount", "units", "description", "grams") +
+              NUTRIENT_NAMES)
+
+    def recipe(self, report):
+        # Verify argument types:
+        assert isinstance(report, RecipeReport)
+
+        renderer = self
+        writer = renderer.writer
+        name = report.name
+        scale = report.scale
+        for ingredient in report.ingredients:
+            writer.writerow([name, scale, ingredient.index, ingredient.amount, ingredient.units,
+              ingredient.description, ingredient.grams] + ingredient.nutrients.tolist())
+        writer.writerow([name, scale, "", "", "", "Total", report.grams] +
+          report.nutrients.tolist())
+        renderer.write("")
+
+    def food(self, food, heading=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+        assert isinstance(heading, str) or heading is None
+
+        renderer = self
+        renderer.writer.writerow(["" if heading is None else heading, "", "", "", "",
+          food.description, food.serving_mass] + food.nutrients.tolist())
+        renderer.write("")
+
+    def error(self, message, heading=None):
+        # Verify argument types:
+        assert isinstance(message, str)
+        assert isinstance(heading, str) or heading is None
+
+        # An error row has the *message* as its description and no nutrients:
+        renderer = self
+        renderer.writer.writerow(["" if heading is None else heading, "", "", "", "",
+          "Error: {0}".format(message), ""] + [""] * NUTRIENTS_SIZE)
+        renderer.write("")
+
 class Day:
     def __init__(self, name):
         # Verify argument types:
         assert isinstance(name, str)
 
         day = self
+        day.name = name
         day.recipe_scale_pairs = list()
+        day.vector = None  # The cached total nutrients of *day* (or *None* when stale)
+        day.mass = 0.0     # The cached total grams of *day*
+
+    def __setstate__(self, state):
+        # Re-register with each *Recipe*, whose list of days is not pickled:
+        day = self
+        day.__dict__.update(state)
+        for recipe, scale in day.recipe_scale_pairs:
+            recipe.days.add(day)
 
     def meal(self, recipe, scale=1.0):
         # Verify argument types:
@@ -46,24 +294,307 @@ class Day:
 
         day = self
         day.recipe_scale_pairs.append( (recipe, scale) )
+        recipe.days.add(day)
+
+        # Add the meal to the cached total if the total of *recipe* is known:
+        if day.vector is not None:
+            if recipe.pending == 0:
+                day.vector += scale * recipe.vector
+                day.mass += scale * recipe.mass
+            else:
+                day.vector = None
+
+    def recipe_changed(self, recipe, delta_vector, delta_mass):
+        # Verify argument types:
+        assert isinstance(recipe, Recipe)
+        assert isinstance(delta_vector, numpy.ndarray) or delta_vector is None
+        assert isinstance(delta_mass, float)
+
+        # Apply a change to the unscaled total of *recipe* to the cached total of *day*
+        # (i.e. *self*), once for each meal of *recipe*:
+        day = self
+        if day.vector is not None:
+            if delta_vector is None:
+                day.vector = None
+            else:
+                scale = sum(meal_scale
+                  for meal_recipe, meal_scale in day.recipe_scale_pairs if meal_recipe is recipe)
+                day.vector += scale * delta_vector
+                day.mass += scale * delta_mass
+
+    def meals_compile(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Return the meal *scales*, the unscaled meal *masses* and the unscaled meals x
+        # nutrients *vectors* of *day* (i.e. *self*):
+        day = self
+        recipe_scale_pairs = day.recipe_scale_pairs
+        size = len(recipe_scale_pairs)
+        scales = numpy.empty(size, dtype=numpy.float64)
+        masses = numpy.empty(size, dtype=numpy.float64)
+        vectors = numpy.empty((size, NUTRIENTS_SIZE), dtype=numpy.float64)
+        for meal_index, recipe_scale_pair in enumerate(recipe_scale_pairs):
+            recipe, scale = recipe_scale_pair
+            matrix, grams, vector = recipe.compile(client, resolver=resolver)
+            scales[meal_index] = scale
+            masses[meal_index] = recipe.mass
+            vectors[meal_index] = vector
+        return scales, masses, vectors
+
+    def sweep(self, client=None, scales=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert scales is not None, "No meal scales to sweep"
+        assert isinstance(resolver, FoodResolver) or resolver is None
 
-    def process(self, client):
+        # *scales* is a scenarios x meals matrix of meal scales to try in place of the meal
+        # scales of *day* (i.e. *self*).  Since each recipe total is linear in its scale, the
+        # scenarios x nutrients totals are one matrix product with the meals x nutrients matrix:
+        day = self
+        scales = numpy.asarray(scales, dtype=numpy.float64)
+        meal_scales, masses, vectors = day.meals_compile(client, resolver=resolver)
+        if scales.ndim == 1:
+            scales = scales.reshape(1, -1)
+        assert scales.ndim == 2 and scales.shape[1] == len(meal_scales), \
+          "Expected a scenarios x {0} matrix of scales".format(len(meal_scales))
+        totals = scales @ vectors
+        return totals
+
+    def process(self, client=None, resolver=None, renderer=None, quiet=False):
         # Verify argument types:
-        assert isinstance(client, usda.client.UsdaClient)
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+        assert isinstance(renderer, BufferedRenderer) or renderer is None
+        assert isinstance(quiet, bool)
 
+        # Every recipe of *day* (i.e. *self*) shares one *renderer* (text on *sys.stdout* by
+        # default), which is flushed once at the end:
         day = self
+        if renderer is None and not quiet:
+            renderer = TextRenderer()
         recipe_scale_pairs = day.recipe_scale_pairs
         day_total = Food.empty()
-        for recipe, scale in recipe_scale_pairs:
-            recipe_total = recipe.process(client, scale)
-            day_total += recipe_total
+        with Stats.scope("day", day.name):
+            for recipe, scale in recipe_scale_pairs:
+                recipe_total = recipe.process(client, scale, resolver=resolver,
+                  renderer=renderer, quiet=quiet)
+                with Stats.timer("aggregation"):
+                    day_total += recipe_total
+            if renderer is not None:
+                with Stats.timer("render"):
+                    renderer.flush()
+        return day_total
+
+    def reports_get(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Return a *RecipeReport* for each meal of *day* (i.e. *self*):
+        day = self
+        reports = [recipe.report_get(client, scale, resolver=resolver)
+          for recipe, scale in day.recipe_scale_pairs]
+        return reports
+
+    def evaluate(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Recompute the total of *day* (i.e. *self*) only when it is not already cached:
+        day = self
+        if day.vector is None:
+            # The day total is a single vector-matrix product of the meal scales with the
+            # meals x nutrients matrix:
+            with Stats.scope("day", day.name):
+                scales, masses, vectors = day.meals_compile(client, resolver=resolver)
+                with Stats.timer("aggregation"):
+                    day.mass = float(scales @ masses)
+                    day.vector = scales @ vectors
+        else:
+            Stats.count("day_cache_hits")
+        day_total = Food._derived("Total", 0.0, "", day.mass, -1, day.vector.copy(), None, -1)
         return day_total
 
+class FetchScheduler:
+    def __init__(self, client, rate=1000.0 / 3600.0, burst=20, retries=4, backoff=1.0,
+      maximum_backoff=60.0, seed=None):
+        # Verify argument types:
+        assert food_source_check(client)
+        assert (isinstance(rate, float) or isinstance(rate, int)) and rate > 0
+        assert isinstance(burst, int) and burst >= 2
+        assert isinstance(retries, int) and retries >= 0
+        assert isinstance(backoff, float) or isinstance(backoff, int)
+        assert isinstance(maximum_backoff, float) or isinstance(maximum_backoff, int)
+
+        # Load up *scheduler* (i.e. *self*).  Every USDA request takes a token from a bucket
+        # that holds up to *burst* tokens and refills at *rate* tokens per second (the default
+        # is the api.data.gov quota of 1000 requests per hour):
+        scheduler = self
+        scheduler.client          = client
+        scheduler.rate            = rate
+        scheduler.burst           = burst
+        scheduler.tokens          = float(burst)
+        scheduler.updated         = time.monotonic()   # When *tokens* was last refilled
+        scheduler.retries         = retries            # Retries after the first attempt
+        scheduler.backoff         = backoff            # Seconds before the first retry...
+        scheduler.maximum_backoff = maximum_backoff    # ...doubling up to this many
+        scheduler.random          = random.Random(seed)
+        scheduler.lock            = threading.Lock()   # Protects everything below
+        scheduler.in_flight       = dict()             # food_id => *concurrent.futures.Future*
+
+        # Metrics (see *metrics_get*()):
+        scheduler.requests        = 0                  # USDA requests (tokens) taken
+        scheduler.fetches         = 0                  # Foods fetched from the USDA
+        scheduler.coalesced       = 0                  # Fetches that joined one in flight
+        scheduler.retried         = 0                  # Attempts that were retried
+        scheduler.failures        = 0                  # Fetches that gave up
+        scheduler.waiting         = 0                  # Requests waiting for a token
+        scheduler.maximum_waiting = 0
+        scheduler.latencies       = collections.deque(maxlen=1000)  # Recent fetch seconds
+
+    def tokens_acquire(self, count):
+        # Block until *count* tokens can be taken from the bucket of *scheduler* (i.e. *self*):
+        scheduler = self
+        with scheduler.lock:
+            scheduler.waiting += 1
+            scheduler.maximum_waiting = max(scheduler.maximum_waiting, scheduler.waiting)
+        try:
+            while True:
+                with scheduler.lock:
+                    now = time.monotonic()
+                    scheduler.tokens = min(float(scheduler.burst),
+                      scheduler.tokens + (now - scheduler.updated) * scheduler.rate)
+                    scheduler.updated = now
+                    if scheduler.tokens >= count:
+                        scheduler.tokens -= count
+                        scheduler.requests += count
+                        return
+                    delay = (count - scheduler.tokens) / scheduler.rate
+                time.sleep(delay)
+        finally:
+            with scheduler.lock:
+                scheduler.waiting -= 1
+
+    @staticmethod
+    def rate_limited(error):
+        # Return *True* if *error* is the USDA rate limit.  `usda` is not imported just to
+        # check; if it has never been imported, *error* cannot have come from it:
+        usda_base = sys.modules.get("usda.base")
+        return usda_base is not None and isinstance(error, usda_base.DataGovApiRateExceededError)
+
+    @staticmethod
+    def retryable(error):
+        # Return *True* if *error* is worth retrying: the rate limit, a connection problem,
+        # a time out, a 429 or a 5xx response:
+        if FetchScheduler.rate_limited(error):
+            return True
+        requests = sys.modules.get("requests")
+        if requests is None:
+            return False
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError):
+            response = error.response
+            return response is None or response.status_code == 429 or \
+              response.status_code >= 500
+        return False
+
+    def fetch(self, food_id):
+        # Verify argument types:
+        assert isinstance(food_id, str) or isinstance(food_id, int)
+
+        # Return the *Food* for *food_id* from the USDA.  Concurrent fetches of the same
+        # *food_id* share a single request (single flight):
+        scheduler = self
+        key = str(food_id)
+        with scheduler.lock:
+            future = scheduler.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                scheduler.in_flight[key] = future
+            else:
+                scheduler.coalesced += 1
+        if leader:
+            try:
+                future.set_result(scheduler._fetch_retrying(food_id))
+            except BaseException as error:
+                future.set_exception(error)
+            finally:
+                with scheduler.lock:
+                    del scheduler.in_flight[key]
+        return future.result()
+
+    def _fetch_retrying(self, food_id):
+        # Fetch *food_id*, retrying transient errors after a jittered, exponentially growing
+        # delay ("full jitter", so that many retrying threads do not all wake up together):
+        scheduler = self
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            scheduler.tokens_acquire(2)  # *Food.usda_fetch* makes two requests
+            try:
+                food = Food.fetch(scheduler.client, food_id)
+                break
+            except BaseException as error:
+                if attempt >= scheduler.retries or not FetchScheduler.retryable(error):
+                    with scheduler.lock:
+                        scheduler.failures += 1
+                    raise
+                with scheduler.lock:
+                    scheduler.retried += 1
+                    if FetchScheduler.rate_limited(error):
+                        scheduler.tokens = 0.0  # Slow every other request down too
+                    delay = scheduler.random.uniform(0.0,
+                      min(scheduler.maximum_backoff, scheduler.backoff * (2 ** attempt)))
+                Stats.count("fetch_retries")
+                time.sleep(delay)
+                attempt += 1
+        with scheduler.lock:
+            scheduler.fetches += 1
+            scheduler.latencies.append(time.monotonic() - started)
+        return food
+
+    def metrics_get(self):
+        # Return the metrics of *scheduler* (i.e. *self*) as a *dict*; the latencies are
+        # over the most recent fetches and include any rate limiting and retries:
+        scheduler = self
+        with scheduler.lock:
+            latencies = numpy.array(scheduler.latencies, dtype=numpy.float64)
+            metrics = {
+              "requests":        scheduler.requests,
+              "fetches":         scheduler.fetches,
+              "coalesced":       scheduler.coalesced,
+              "retried":         scheduler.retried,
+              "failures":        scheduler.failures,
+              "in_flight":       len(scheduler.in_flight),
+              "queue_depth":     scheduler.waiting,
+              "maximum_queue_depth": scheduler.maximum_waiting,
+              "tokens":          scheduler.tokens,
+            }
+        if len(latencies) > 0:
+            p50, p90, p99 = numpy.percentile(latencies, [50.0, 90.0, 99.0])
+            metrics.update(latency_p50=float(p50), latency_p90=float(p90),
+              latency_p99=float(p99), latency_maximum=float(latencies.max()))
+        return metrics
+
 class Food:
+    # A *Food* has no `__dict__`, which keeps the millions of them that a large catalog or
+    # meal log can create small (the nutrients are properties on top of *nutrients*):
+    __slots__ = ("description", "serving_amount", "serving_units", "serving_mass", "density",
+      "nutrients", "upc", "food_id", "measures")
+
+    # The inline foods that ingredients can refer to by UPC alone (see *Food.inline_add*),
+    # keyed by normalized UPC:
+    inline_foods = dict()
+
     def __init__(self, description, serving_amount, serving_units, serving_mass, calories,
       total_fat, saturated_fat, trans_fat, cholesterol, sodium,
       carbohydrates, dietary_fiber, sugars, protein,
-      calcium=None, potassium=None, upc=None, food_id=None):
+      calcium=None, potassium=None, upc=None, food_id=None, measures=None):
         # Verify argument types:
         assert isinstance(description, str)
         assert isinstance(serving_amount, float) or isinstance(serving_amount, int)
@@ -83,6 +614,7 @@ class Food:
         assert isinstance(potassium, float)      or isinstance(potassium, int) or potassium is None
         assert isinstance(upc, str)              or upc is None
         assert isinstance(food_id, int)          or food_id is None
+        assert isinstance(measures, dict)        or measures is None
 
         #print("=>Food.__init__(*, '{0}', ..., food_id={1}, upc={2})".
         #  format( description, food_id, (None if upc is None else "'{0}'".format(upc)) ))
@@ -108,6 +640,18 @@ class Food:
         if potassium is None:
             potassium = 0.0
 
+        # Every known serving measure is kept as grams per unit, starting with the serving:
+        measures = dict() if measures is None else dict(measures)
+        if serving_units != "" and serving_amount > 0:
+            measures.setdefault(serving_units, serving_mass / serving_amount)
+
+        # The nutrient values are stored in *NUTRIENT_NAMES* order as a single vector so that
+        # addition and scaling are done as one vector operation rather than twelve:
+        nutrients = numpy.array((calories, total_fat, saturated_fat, trans_fat, cholesterol,
+          sodium, carbohydrates, dietary_fiber, sugars, protein, calcium, potassium),
+          dtype=numpy.float64)
+        nutrients *= scale
+
         # Stuff arugments in to *food* (i.e. *self*):
         food = self
         food.description    = description            # Text
@@ -115,50 +659,97 @@ class Food:
         food.serving_units  = serving_units          # The units (e.g. "cup", "tsp", "oz".)
         food.serving_mass   = serving_mass           # The number of grams per serving.
         food.density        = density                # The density of the food (g/ml^3)
-        food.calories       = scale * calories       # The energy per 100 grams (kcal)
-        food.total_fat      = scale * total_fat      # The total fat per 100 grams (g)
-        food.saturated_fat  = scale * saturated_fat  # The staturated fat per 100 grams (g)
-        food.trans_fat      = scale * trans_fat      # The tran fat per 100 grams (g)
-        food.cholesterol    = scale * cholesterol    # The cholesterol per 100 grams (mg)
-        food.sodium         = scale * sodium         # The sodium per 100 grams (mg)
-        food.carbohydrates  = scale * carbohydrates  # The total carbohydrates per 100 grams (g)
-        food.dietary_fiber  = scale * dietary_fiber  # The dietary fiber per 100 grams (g)
-        food.sugars         = scale * sugars         # The surgars per 100 grams (g)
-        food.protein        = scale * protein        # The protein per 100 grams (g)
-        food.calcium        = scale * calcium        # The calcium per 100 grams (mg)
-        food.potassium      = scale * potassium      # The potassium per 100 grams (g)
+        food.nutrients      = nutrients              # The *NUTRIENT_NAMES* values per 100 grams
         food.upc            = upc                    # The UPC code as *str* or *None*
         food.food_id        = food_id                # The USDA food id as *int* or *None*
+        food.measures       = measures               # units => grams per unit (or *None*)
 
         #print("<=Food.__init__(*, '{0}', ..., food_id={1}, upc={2})".
         #  format( description, food_id, (None if upc is None else "'{0}'".format(upc)) ))
 
+    @staticmethod
+    def _derived(description, serving_amount, serving_units, serving_mass, density, nutrients,
+      upc, food_id, measures=None):
+        # Create a *Food* from values that have already been validated and normalized
+        # (i.e. the results of *Food* arithmetic).  *nutrients* is used as is, not copied:
+        food = Food.__new__(Food)
+        food.description    = description
+        food.serving_amount = serving_amount
+        food.serving_units  = serving_units
+        food.serving_mass   = serving_mass
+        food.density        = density
+        food.nutrients      = nutrients
+        food.upc            = upc
+        food.food_id        = food_id
+        food.measures       = measures
+        return food
+
+    def __getstate__(self):
+        # Pickle as a *dict*, just like before *Food* had `__slots__`:
+        food = self
+        return {name: getattr(food, name) for name in Food.__slots__}
+
+    def __setstate__(self, state):
+        # Older pickles store each nutrient as a separate attribute; fold them into a vector:
+        if "nutrients" not in state:
+            state = dict(state)
+            state["nutrients"] = numpy.array(
+              [float(state.pop(name, 0.0) or 0.0) for name in NUTRIENT_NAMES],
+              dtype=numpy.float64)
+        if "measures" not in state:
+            state = dict(state)
+            state["measures"] = None
+        food = self
+        for name in Food.__slots__:
+            setattr(food, name, state[name])
+
     def __add__(self, food2):
         # Verify argument types:
         assert isinstance(food2, Food)
 
         food1 = self
-        sum = Food("Total",
-          0.0,
-          "",
-          food1.serving_mass        + food2.serving_mass,
-          food1.calories            + food2.calories,
-          food1.total_fat           + food2.total_fat,
-          food1.saturated_fat       + food2.saturated_fat,
-          food1.trans_fat           + food2.trans_fat,
-          food1.cholesterol         + food2.cholesterol,
-          food1.sodium              + food2.sodium,
-          food1.carbohydrates       + food2.carbohydrates,
-          food1.dietary_fiber       + food2.dietary_fiber,
-          food1.sugars              + food2.sugars,
-          food1.protein             + food2.protein,
-          calcium=food1.calcium     + food2.calcium,
-          potassium=food1.potassium + food2.potassium,
-          food_id=-1)
-        sum.serving_mass = food1.serving_mass + food2.serving_mass
-        sum.calories     = food1.calories     + food2.calories
+        sum = Food._derived("Total", 0.0, "", food1.serving_mass + food2.serving_mass, -1,
+          food1.nutrients + food2.nutrients, None, -1)
         return sum
 
+    def __radd__(self, other):
+        # Allow the builtin `sum()` to be used, which starts with `0 + food`:
+        assert isinstance(other, Food) or other == 0
+
+        food = self
+        if isinstance(other, Food):
+            return other + food
+        return Food._derived("Total", 0.0, "", food.serving_mass, -1,
+          food.nutrients.copy(), None, -1)
+
+    def __iadd__(self, food2):
+        # Verify argument types:
+        assert isinstance(food2, Food)
+
+        # Accumulate into the existing *nutrients* buffer of *food1* (i.e. *self*) when it is a
+        # running total from *Food.empty*() or *Food.sum*().  Any other *Food* may be shared
+        # (an inline food, a food memoized by a *FoodResolver*, ...), so it is left alone and a
+        # new total is returned instead:
+        food1 = self
+        if type(food1) is not _FoodTotal:
+            return Food.sum((food1, food2))
+        food1.nutrients += food2.nutrients
+        food1.serving_mass += food2.serving_mass
+        return food1
+
+    @staticmethod
+    def sum(foods):
+        # Total up *foods* into a single buffer without creating a temporary *Food* per item:
+        total = Food.empty()
+        nutrients = total.nutrients
+        serving_mass = 0.0
+        for food in foods:
+            assert isinstance(food, Food)
+            nutrients += food.nutrients
+            serving_mass += food.serving_mass
+        total.serving_mass = serving_mass
+        return total
+
     def __mul__(self, grams):
         # Verify argument types:
         assert isinstance(grams, float)
@@ -182,39 +773,9 @@ class Food:
             #assert False, "Unknown serving unit '{0}':'{1}'".format(
             #  food.description, serving_units)
 
-        scaled = Food(
-          "{0}g of {1} ".format(grams, food.description),
-          serving_amount,
-          serving_units,
-          grams,
-          food.calories             * scale,
-          food.total_fat            * scale,
-          food.saturated_fat        * scale,
-          food.trans_fat            * scale,
-          food.cholesterol          * scale,
-          food.sodium               * scale,
-          food.carbohydrates        * scale,
-          food.dietary_fiber        * scale,
-          food.sugars               * scale,
-          food.protein              * scale,
-          calcium=(food.calcium     * scale),
-          potassium=(food.potassium * scale),
-          food_id=food.food_id,
-          upc=food.upc
-        )
-        scaled.serving_mass  = grams
-        scaled.calories      = food.calories      * scale
-        scaled.total_fat     = food.total_fat     * scale
-        scaled.satruated_fat = food.saturated_fat * scale
-        scaled.trans_fat     = food.trans_fat     * scale
-        scaled.cholesterol   = food.cholesterol   * scale
-        scaled.sodium        = food.sodium        * scale
-        scaled.carbohydrates = food.carbohydrates * scale
-        scaled.dietary_fiber = food.dietary_fiber * scale
-        scaled.sugars        = food.sugars        * scale
-        scaled.protein       = food.protein       * scale
-        scaled.calcium       = food.calcium       * scale
-        scaled.potassium     = food.potassium     * scale
+        scaled = Food._derived("{0}g of {1} ".format(grams, food.description),
+          serving_amount, serving_units, grams, food.density, food.nutrients * scale,
+          food.upc, food.food_id, food.measures)
         #print("food.sodium={0} scale=(1:.2f) scaled.sodium={2}".
         #  format(food.sodium, scale, scaled.sodium))
 
@@ -222,11 +783,187 @@ class Food:
 
     @staticmethod
     def empty():
-        food = Food("Total", 0, "", 100, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, upc="", food_id=-1)
-        food.calories = 0.0
-        food.serving_mass = 0.0
+        # Return a new running total (see *Food.__iadd__*):
+        food = Food._derived("Total", 0, "", 0.0, -1,
+          numpy.zeros(NUTRIENTS_SIZE, dtype=numpy.float64), "", -1)
+        food.__class__ = _FoodTotal
+        return food
+
+    @staticmethod
+    def fetch(client, food_id):
+        # Return the *Food* for *food_id* from the data source *client* (see
+        # *food_source_check*).  Without a *client* only inline and stored foods are available:
+        assert client is not None, "No data source to fetch food id {0} from".format(food_id)
+        food_fetch = getattr(client, "food_fetch", None)
+        if food_fetch is not None:
+            return food_fetch(food_id)
+        return Food.usda_fetch(client, food_id)
+
+    @staticmethod
+    def inline_add(food):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        # Make the inline *food* (e.g. `Food(..., upc=...)`) the food of its UPC, so that any
+        # later `Ingredient(upc=...)` finds it before the catalog and the store are searched.
+        # A later definition of the same UPC replaces an earlier one:
+        if food.upc:
+            Food.inline_foods[upc_normalize(food.upc)] = food
+
+    @staticmethod
+    def inline_get(upc):
+        # Return the inline *Food* defined for *upc* (see *Food.inline_add*) or *None*:
+        return Food.inline_foods.get(upc_normalize(upc))
+
+    @staticmethod
+    def usda_fetch(client, food_id):
+        import usda.domain
+
+        # Verify argument types:
+        assert hasattr(client, "search_foods") and hasattr(client, "get_food_report")
+        assert isinstance(food_id, str) or isinstance(food_id, int)
+
+        # Initialize all of the *Food* object fields to *None* except *food_id*:
+        description    = None
+        serving_amount = None
+        serving_units  = None
+        serving_mass   = None
+        calories       = None
+        total_fat      = None
+        saturated_fat  = None
+        trans_fat      = None
+        cholesterol    = None
+        sodium         = None
+        carbohydrates  = None
+        dietary_fiber  = None
+        sugars         = None
+        protein        = None
+        calcium        = None
+        potassium      = None
+        upc            = None
+        food_measures  = dict()
+
+        #print("food_id={0} upc={1}".
+        #  format(food_id, (None if upc is None else "'{1}'".format(upc)) ))
+        Stats.count("fetches")
+        with Stats.timer("fetch"):
+            search = client.search_foods(food_id, 1)
+            food_item = next(search)
+        assert isinstance(food_item, usda.domain.Food)
+        food_name = food_item.name
+        #print("food_name='{0}'".format(food_name))
+        #assert(food_id == food_item.id)
+        #food_upc_index = food_name.find("UPC: ")
+        #food_upc = food_name[food_upc_index + 5:] if food_upc_index >= 0 else None
+
+        #print("food_id={0} upc={1}".
+        #  format(food_id, (None if upc is None else "'{0}'".format(upc))))
+
+        # Get the nutrient report:
+        #report_dict = client.get_food_report_raw(ndbno=food_id)
+        #assert isinstance(report_dict, dict)
+        #pprint.pprint(report_dict)
+        #print(raw_report)
+
+        with Stats.timer("fetch"):
+            report = client.get_food_report(food_id)
+        nutrients = list(report.nutrients)
+        for nutrient_index, nutrient in enumerate(nutrients):
+            # Extract the *nutrient* values:
+            nutrient_name = nutrient.name
+            nutrient_unit = nutrient.unit
+            nutrient_value = nutrient.value
+
+            # We only need to grab the *serving_amount*, *serving_units*, and *serving_mass*
+            # once:
+            if nutrient_index == 0:
+                measures = nutrient.measures
+                #print("measures_type=", type(measures))
+                for measure_index, measure in enumerate(measures):
+                    # Get the *serving_amount*, *serving_mass*, and *serving_units*
+                    # from *measure*:
+                    serving_amount = measure.quantity
+                    serving_mass   = float(measure.gram_equivalent)
+                    serving_units  = units_normalize(measure.label)
+
+                    # Keep every measure (e.g. "clove", "slice", "large") as grams per unit:
+                    if serving_amount > 0 and serving_units != "":
+                        food_measures.setdefault(serving_units, serving_mass / serving_amount)
+
+                    # Print out the serving size information:
+                    #print("Measure[{3}]  {0}{1} => {2}gm".
+                    #  format(serving_amount, serving_units, serving_mass, measure_index))
+
+            #print("  {0}: {1}{2}".format(nutrient_name, nutrient_value, nutrient_unit))
+            if nutrient_name == "Energy":
+                assert nutrient_unit == "kcal"
+                calories = nutrient_value
+            elif nutrient_name == "Total lipid (fat)":
+                assert nutrient_unit == "g"
+                total_fat = nutrient_value
+            elif nutrient_name == "Fatty acids, total saturated":
+                assert nutrient_unit == "g"
+                saturated_fat = nutrient_value
+            elif nutrient_name == "Fatty acids, total trans":
+                assert nutrient_unit == "g"
+                trans_fat = nutrient_value
+            elif nutrient_name == "Cholesterol":
+                assert nutrient_unit == "mg"
+                cholesterol = nutrient_value
+            elif nutrient_name == "Sodium, Na":
+                assert nutrient_unit == "mg"
+                sodium = nutrient_value
+            elif nutrient_name == "Carbohydrate, by difference":
+                assert nutrient_unit == "g"
+                carbohydrates = nutrient_value
+            elif nutrient_name == "Fiber, total dietary":
+                assert nutrient_unit == "g"
+                dietary_fiber = nutrient_value
+            elif nutrient_name ==  "Sugars, total":
+                assert nutrient_unit == "g"
+                sugars = nutrient_value
+            elif nutrient_name == "Protein":
+                assert nutrient_unit == "g"
+                protein = nutrient_value
+            elif nutrient_name == "Potassium, K":
+                assert nutrient_unit == "mg"
+                potassium = nutrient_value
+            elif nutrient_name == "Calcium, Ca":
+                assert nutrient_unit == "mg"
+                calcium = nutrient_value
+            #else:
+            #    print("  -->{0}: {1}{2}".format(nutrient_name, nutrient_value, nutrient_unit))
+
+        food = Food(food_name, serving_amount, serving_units, serving_mass, calories,
+          total_fat, saturated_fat, trans_fat, cholesterol, sodium,
+          carbohydrates, dietary_fiber, sugars, protein,
+          calcium=calcium, potassium=potassium, upc=upc, food_id=food_id,
+          measures=food_measures)
         return food
 
+    def grams_per_unit_get(self, units):
+        # Verify argument types:
+        assert isinstance(units, str)
+
+        # Return the number of grams in one *units* of *food* (i.e. *self*):
+        food = self
+        if units in MASS_CONVERSIONS:
+            return MASS_CONVERSIONS[units]
+        measures = food.measures
+        if measures is None:
+            measures = dict()
+        if units in measures:
+            return measures[units]
+        if units in VOLUME_CONVERSIONS:
+            # Any other volume measure gives the density:
+            density = food.density
+            for measure_units, grams in measures.items():
+                if density <= 0.0 and measure_units in VOLUME_CONVERSIONS:
+                    density = grams / VOLUME_CONVERSIONS[measure_units]
+            assert density > 0.0, "No density for '{0}'".format(food.description)
+            return density * VOLUME_CONVERSIONS[units]
+        assert False, "No valid conversion for '{0}' of '{1}'".format(units, food.description)
+
     def caloric_fractions_get(self):
         food = self
         total_fat     = food.total_fat
@@ -240,8 +977,6 @@ class Food:
         protein_fraction       = protein       / caloric_grams
         #print("sum(fractions)={0}".
         #  format(fat_fraction + carbohydrates_fraction + protein_fraction))
-        food.calories = 0
-        food.serving_mass = 0
         return (fat_fraction, carbohydrates_fraction, protein_fraction)
 
     def summary_string(self, scale=1.0):
@@ -295,283 +1030,3070 @@ class Food:
         text = '\n'.join(lines)
         return text
 
-class Ingredient:
-    # Conversion coefficients to milliLiters:
-    def __init__(self, amount, units, description, food_id=None, upc=None, food=None):
-        # Verifya argument types:
-        assert isinstance(amount, float)
-        assert isinstance(units, str)
-        assert isinstance(description, str)
-        assert isinstance(food_id, str) or isinstance(food_id, int) or food_id is None
-        assert isinstance(upc, str) or upc is None
-        assert isinstance(food, Food) or food is None
-        count = 0
-        count += isinstance(food_id, str) or isinstance(food_id, int)
-        count += isinstance(upc, str)
-        count += isinstance(food, Food)
-        assert count == 1
+def _nutrient_property(index):
+    # Return a property that reads and writes slot *index* of *Food.nutrients*:
+    def getter(food):
+        return float(food.nutrients[index])
+    def setter(food, value):
+        food.nutrients[index] = value
+    return property(getter, setter)
 
-        # Load arguments into *ingredient* (i.e. *self*):
-        ingredient = self
-        ingredient.amount      = float(amount)
-        ingredient.units       = units.lower()
-        ingredient.description = description
-        ingredient.food_id     = food_id
-        ingredient.upc         = upc
-        ingredient.food        = food
-        
-    def food_lookup(self, client):
-        #print("=>Ingredient.food_lookup(*)")
+# Make each nutrient (e.g. `food.calories`) accessible by name:
+for nutrient_index, nutrient_name in enumerate(NUTRIENT_NAMES):
+    setattr(Food, nutrient_name, _nutrient_property(nutrient_index))
+del nutrient_index, nutrient_name
+
+class _FoodTotal(Food):
+    # The running total returned by *Food.empty*() and *Food.sum*(), which is the only kind
+    # of *Food* that `+=` adds to in place:
+    __slots__ = ()
+
+class FoodCatalog:
+    # The version of the on disk layout written by *FoodCatalog.write*() (version 2 had no
+    # `row_upcs` column, so it can still be read):
+    LAYOUT_VERSION = 3
 
+    # The process wide catalog returned by *FoodCatalog.default_get*():
+    default_catalog = None
+
+    def __init__(self, path):
         # Verify argument types:
-        assert isinstance(client, UsdaClient)
+        assert isinstance(path, str)
 
-        # Grap the *food_id* from *ingredient* (i.e. *self*):
-        ingredient = self
+        # Each column is a separate `.npy` file that is memory-mapped rather than read, so
+        # opening a catalog is (nearly) free and only the pages that are touched are loaded:
+        def column(name):
+            return numpy.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        with open(os.path.join(path, "catalog.json")) as header_file:
+            header = json.load(header_file)
+        assert header["version"] in (2, FoodCatalog.LAYOUT_VERSION), \
+          "Catalog '{0}' has layout version {1}".format(path, header["version"])
+        assert tuple(header["nutrient_names"]) == NUTRIENT_NAMES
 
-        food = ingredient.food
+        # Load up *catalog* (i.e. *self*):
+        catalog = self
+        catalog.path                = path
+        catalog.fallback            = None                      # Searched on a miss (or *None*)
+        catalog.size                = header["size"]            # The number of foods
+        catalog.units               = header["units"]           # Measure unit names
+        catalog.id_keys             = column("id_keys")         # Sorted food ids
+        catalog.id_rows             = column("id_rows")         # Row of each of *id_keys*
+        catalog.row_ids             = column("row_ids")         # The FDC id of each row
+        catalog.upc_keys            = column("upc_keys")        # Sorted EAN-13 codes
+        catalog.upc_rows            = column("upc_rows")        # Row of each of *upc_keys*
+        catalog.row_upcs            = None                      # The EAN-13 of each row or -1
+        catalog.nutrients           = column("nutrients")       # Per 100 grams (rows x nutrients)
+        catalog.description_offsets = column("description_offsets")  # Into *descriptions*
+        catalog.descriptions        = column("descriptions")    # UTF-8 descriptions (uint8)
+        catalog.measure_offsets     = column("measure_offsets")     # Measures of each row
+        catalog.measure_amounts     = column("measure_amounts")     # Serving amounts
+        catalog.measure_units       = column("measure_units")       # Indices into *units*
+        catalog.measure_grams       = column("measure_grams")       # Grams per serving
+        if header["version"] >= 3:
+            catalog.row_upcs = column("row_upcs")
+        else:
+            row_upcs = numpy.full(catalog.size, -1, dtype=numpy.int64)
+            row_upcs[catalog.upc_rows[::-1]] = catalog.upc_keys[::-1]
+            catalog.row_upcs = row_upcs
 
-        description = ingredient.description
-        file_name = "/tmp/" + description.replace(" ", "_") + ".pkl"
-        if food is None:
-            if os.path.isfile(file_name):
-                with open(file_name, "rb") as pickle_file:
-                    food= pickle.load(pickle_file)
-        if food is None:
-            # Initialize all of the *Food* object fields to *None* except *food_id*:
-            description    = None
-            serving_amount = None
-            serving_units  = None
-            serving_mass   = None
-            calories       = None
-            total_fat      = None
-            saturated_fat  = None
-            trans_fat      = None
-            cholesterol    = None
-            sodium         = None
-            carbohydrates  = None
-            dietary_fiber  = None
-            sugars         = None
-            protein        = None
-            calcium        = None
-            potassium      = None
-            upc            = None
-    
-            #print("food_id={0} upc={1}".
-            #  format(food_id, (None if upc is None else "'{1}'".format(upc)) ))
-            food_id = ingredient.food_id
-            assert not food_id is None
-            search = client.search_foods(food_id, 1)
-            food_item = next(search)
-            assert isinstance(food_item, usda.domain.Food)
-            food_name = food_item.name
-            #print("food_name='{0}'".format(food_name))
-            #assert(food_id == food_item.id)
-            #food_upc_index = food_name.find("UPC: ")
-            #food_upc = food_name[food_upc_index + 5:] if food_upc_index >= 0 else None
-    
-            #print("food_id={0} upc={1}".
-            #  format(food_id, (None if upc is None else "'{0}'".format(upc))))
-    
-            # Get the nutrient report:
-            #report_dict = client.get_food_report_raw(ndbno=food_id)
-            #assert isinstance(report_dict, dict)
-            #pprint.pprint(report_dict)
-            #print(raw_report)
-    
-            report = client.get_food_report(food_id)
-            nutrients = list(report.nutrients)
-            for nutrient_index, nutrient in enumerate(nutrients):
-                # Extract the *nutrient* values:
-                nutrient_name = nutrient.name
-                nutrient_unit = nutrient.unit
-                nutrient_value = nutrient.value
-    
-                # We only need to grab the *serving_amount*, *serving_units*, and *serving_mass*
-                # once:
-                if nutrient_index == 0:
-                    measures = nutrient.measures
-                    #print("measures_type=", type(measures))
-                    for measure_index, measure in enumerate(measures):
-                        # Get the *serving_amount*, *serving_mass*, and *serving_units*
-                        # from *measure*:
-                        serving_amount = measure.quantity
-                        serving_mass   = float(measure.gram_equivalent)
-                        serving_units  = measure.label.lower()
-    
-                        # Sometimes *serving_units* is has some extra information... Trim it off:
-                        space_index = serving_units.find(' ')
-                        if space_index >=0:
-                            serving_units = serving_units[:space_index]
-    
-                        # Print out the serving size information:
-                        #print("Measure[{3}]  {0}{1} => {2}gm".
-                        #  format(serving_amount, serving_units, serving_mass, measure_index))
-    
-                #print("  {0}: {1}{2}".format(nutrient_name, nutrient_value, nutrient_unit))
-                if nutrient_name == "Energy":
-                    assert nutrient_unit == "kcal"
-                    calories = nutrient_value
-                elif nutrient_name == "Total lipid (fat)":
-                    assert nutrient_unit == "g"
-                    total_fat = nutrient_value
-                elif nutrient_name == "Fatty acids, total saturated":
-                    assert nutrient_unit == "g"
-                    saturated_fat = nutrient_value
-                elif nutrient_name == "Fatty acids, total trans":
-                    assert nutrient_unit == "g"
-                    trans_fat = nutrient_value
-                elif nutrient_name == "Cholesterol":
-                    assert nutrient_unit == "mg"
-                    cholesterol = nutrient_value
-                elif nutrient_name == "Sodium, Na":
-                    assert nutrient_unit == "mg"
-                    sodium = nutrient_value
-                elif nutrient_name == "Carbohydrate, by difference":
-                    assert nutrient_unit == "g"
-                    carbohydrates = nutrient_value
-                elif nutrient_name == "Fiber, total dietary":
-                    assert nutrient_unit == "g"
-                    dietary_fiber = nutrient_value
-                elif nutrient_name ==  "Sugars, total":
-                    assert nutrient_unit == "g"
-                    sugars = nutrient_value
-                elif nutrient_name == "Protein":
-                    assert nutrient_unit == "g"
-                    protein = nutrient_value
-                elif nutrient_name == "Potassium, K":
-                    assert nutrient_unit == "mg"
-                    potassium = nutrient_value
-                elif nutrient_name == "Calcium, Ca":
-                    assert nutrient_unit == "mg"
-                    calcium = nutrient_value
-                #else:
-                #    print("  -->{0}: {1}{2}".format(nutrient_name, nutrient_value, nutrient_unit))
-                    
-            food = Food(food_name, serving_amount, serving_units, serving_mass, calories,
-              total_fat, saturated_fat, trans_fat, cholesterol, sodium,
-              carbohydrates, dietary_fiber, sugars, protein,
-              calcium=calcium, potassium=potassium, upc=upc, food_id=food_id)
-
-        with open(file_name, "wb") as pickle_file:
-            pickle.dump(food, pickle_file)
-        #print("<=Ingredient.food_lookup(*)")
-        return food
+    @staticmethod
+    def default_get():
+        # Return the catalog at *FOOD_CATALOG_PATH* (or *None* if nothing has been imported):
+        catalog = FoodCatalog.default_catalog
+        if catalog is None and os.path.isfile(os.path.join(FOOD_CATALOG_PATH, "catalog.json")):
+            catalog = FoodCatalog(FOOD_CATALOG_PATH)
+            FoodCatalog.default_catalog = catalog
+        return catalog
 
-class Recipe:
-    def __init__(self, name):
-        # Verify argument types:
-        assert isinstance(name, str)
+    def row_get(self, food_id):
+        # Return the row for *food_id* in *catalog* (i.e. *self*) or -1 if it is not present:
+        catalog = self
+        if isinstance(food_id, str):
+            if not food_id.isdigit():
+                return -1
+            food_id = int(food_id)
+        id_keys = catalog.id_keys
+        index = int(numpy.searchsorted(id_keys, food_id))
+        if index < len(id_keys) and int(id_keys[index]) == food_id:
+            return int(catalog.id_rows[index])
+        return -1
 
-        # Load up *recipe* (i.e. *self*):
-        recipe = self
-        recipe.name = name
-        recipe.ingredients = list()
-        
-    def ingredient(self, amount, units, description, food_id=None, upc=None, food=None):
+    def upc_row_get(self, upc):
+        # Return the row for *upc* in *catalog* (i.e. *self*) or -1 if it is not present:
+        catalog = self
+        upc_key = int(upc_normalize(upc))
+        upc_keys = catalog.upc_keys
+        index = int(numpy.searchsorted(upc_keys, upc_key))
+        if index < len(upc_keys) and int(upc_keys[index]) == upc_key:
+            return int(catalog.upc_rows[index])
+        return -1
+
+    def description_get(self, row):
+        catalog = self
+        offsets = catalog.description_offsets
+        return bytes(catalog.descriptions[offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def measures_get(self, row):
+        # Return the (amount, units, grams) serving measures of *row*:
+        catalog = self
+        units = catalog.units
+        start = int(catalog.measure_offsets[row])
+        end = int(catalog.measure_offsets[row + 1])
+        measures = [(float(catalog.measure_amounts[index]),
+          units[catalog.measure_units[index]], float(catalog.measure_grams[index]))
+          for index in range(start, end)]
+        return measures
+
+    def food_get(self, food_id=None, upc=None):
         # Verify argument types:
-        assert isinstance(amount, float) or isinstance(amount, int)
-        assert isinstance(units, str)
-        assert isinstance(description, str)
         assert isinstance(food_id, str) or isinstance(food_id, int) or food_id is None
         assert isinstance(upc, str) or upc is None
-        assert isinstance(food, Food) or food is None
-        count = 0
-        count += isinstance(food_id, str) or isinstance(food_id, int)
-        count += isinstance(upc, str)
-        count += isinstance(food, Food)
-        assert count == 1
+        assert (food_id is None) != (upc is None)
 
-        # Create *ingredient*:
-        ingredient = Ingredient(float(amount), units, description,
-          food_id=food_id, upc=upc, food=food)
+        # Return *food_id* or *upc* as a *Food* (or *None* if it is not in *catalog*
+        # (i.e. *self*)):
+        catalog = self
+        if upc is None:
+            row = catalog.row_get(food_id)
+            if row >= 0 and catalog.row_upcs[row] >= 0:
+                upc = "{0:013d}".format(int(catalog.row_upcs[row]))
+        else:
+            row = catalog.upc_row_get(upc)
+            food_id = int(catalog.row_ids[row]) if row >= 0 else None
+            upc = upc_normalize(upc)
+        if row < 0:
+            Stats.count("catalog_misses")
+            if catalog.fallback is not None:
+                return catalog.fallback.food_get(food_id=food_id, upc=upc)
+            return None
+        Stats.count("catalog_hits")
 
-        # Append *ingredient* to *recipe* (i.e. *self*):
-        recipe = self
-        recipe.ingredients.append(ingredient)
+        # Prefer a volume measure as the serving so that *Food.density* is available:
+        measures = catalog.measures_get(row)
+        serving_amount, serving_units, serving_mass = 100.0, "g", 100.0
+        for amount, units, grams in measures:
+            if amount > 0.0 and grams > 0.0:
+                serving_amount, serving_units, serving_mass = amount, units, grams
+                if units in VOLUME_CONVERSIONS:
+                    break
+        food_measures = dict()
+        for amount, units, grams in measures:
+            if amount > 0.0 and units != "":
+                food_measures.setdefault(units, grams / amount)
 
-    def process(self, client, scale=1.0):
-        # Verify argument types:
-        assert isinstance(client, UsdaClient)
-        assert isinstance(scale, float) or isinstance(scale, int)
+        # The catalog columns are already per 100 grams and validated when they are written:
+        density = -1
+        if serving_units in VOLUME_CONVERSIONS:
+            density = serving_mass / (serving_amount * VOLUME_CONVERSIONS[serving_units])
+        food_measures.setdefault(serving_units, serving_mass / serving_amount)
+        food = Food._derived(catalog.description_get(row), serving_amount, serving_units,
+          serving_mass, density, numpy.array(catalog.nutrients[row], dtype=numpy.float64),
+          upc, int(food_id), food_measures)
+        return food
 
-        #print("=>Recipe.process(*, *, scale={0})".format(scale))
+    @staticmethod
+    def foods_write(catalog_path, foods):
+        # Verify argument types:
+        assert isinstance(catalog_path, str)
+        assert isinstance(foods, list) or isinstance(foods, tuple)
 
-        # Process the *ingredients* in *recipe* (i.e. *self*):
-        recipe = self
-        print("Recipe: {0}{1}".format(recipe.name,
-          ("" if scale == 1.0 else " x {0:.2}".format(scale)) ))
-        total = Food.empty()
-        ingredients = recipe.ingredients
-        
-        for ingredient_index, ingredient in enumerate(ingredients):
-            amount      = ingredient.amount
-            units       = ingredient.units
-            description = ingredient.description
-
-            #print("Ingredient[{0}] {1}{2} {3} {4}:".
-            #  format(ingredient_index, amount, units,
-            #   (code if isinstance(code, int) else "'{0}'".format(code)), description))
-
-            food = ingredient.food_lookup(client)
+        # Write *foods* (e.g. from *FoodStore.foods_get*) as a catalog at *catalog_path*.  The
+        # serving is written as the first measure so that *food_get* picks it again:
+        aliases = list()
+        upcs = list()
+        descriptions = list()
+        nutrients = numpy.zeros((len(foods), NUTRIENTS_SIZE), dtype=numpy.float64)
+        measures = list()
+        for row, food in enumerate(foods):
             assert isinstance(food, Food)
+            if food.food_id is not None and food.food_id >= 0:
+                aliases.append((food.food_id, row))
+            if food.upc:
+                upcs.append((upc_normalize(food.upc), row))
+            descriptions.append(food.description)
+            nutrients[row] = food.nutrients
+            food_measures = list()
+            if food.serving_units != "" and food.serving_amount > 0:
+                food_measures.append(
+                  (float(food.serving_amount), food.serving_units, float(food.serving_mass)))
+            for units, grams in (food.measures or dict()).items():
+                if units != food.serving_units:
+                    food_measures.append((1.0, units, float(grams)))
+            measures.append(food_measures)
+        FoodCatalog.write(catalog_path, aliases, upcs, descriptions, nutrients, measures)
 
-            grams = None
-            density = None
-            if units in VOLUME_CONVERSIONS:
-                #print("volume converstion")
-                density = food.density
-                assert density > 0.0
-                milliliters = amount * VOLUME_CONVERSIONS[units]
-                grams = density * milliliters
-                #print("process:amount={0} units='{1}' ml={2}, density={3} gm={4}".
-                #  format(amount, units, milliliters, density, grams))
-            elif units in MASS_CONVERSIONS:
-                #print("mass converstion")
-                grams = amount * MASS_CONVERSIONS[units]
-            else:
-                assert False, "No valid conversion for '{0}'".format(units)
-
-            scaled_food = food * (grams * scale)
-            #print("        food.sodium={0} grams={1} scaled_food.sodium={2}".
-            #  format(food.sodium, grams * scale, scaled_food.sodium))
-            total += scaled_food
-
-            calories = scaled_food.calories
-            #print("        food.calories={0} scaled_food.calories={1} scale={2}".format(
-            #  food.calories, scaled_food.calories, scale))
-            #print("        food.density={0} scaled_food.density={1} scale={2}".format(
-            #  food.density, scaled_food.density, scale))
-
-            if units in VOLUME_CONVERSIONS:
-                #print("volume converstion")
-                density = food.density
-                assert density > 0.0
-                milliliters = scaled_food.serving_mass / density
-                new_amount = milliliters / VOLUME_CONVERSIONS[units]
-                #print("process:amount={0} units='{1}' ml={2}, density={3} gm={4}".
-                #  format(amount, units, milliliters, density, grams))
-            elif units in MASS_CONVERSIONS:
-                #print("mass converstion")
-                new_amount = scaled_food.serving_mass / MASS_CONVERSIONS[units]
-            else:
-                assert False, "No valid conversion for '{0}'".format(units)
+    @staticmethod
+    def publish(foods):
+        # Write *foods* as a catalog into shared memory (`/dev/shm` where there is one) and
+        # return its path.  Any number of processes can then open it with *FoodCatalog*(path),
+        # which maps the columns read only, so they all share one copy of the pages.  The
+        # caller removes the directory (`shutil.rmtree`) once they are done with it:
+        directory = tempfile.mkdtemp(prefix="food_tools.",
+          dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        catalog_path = os.path.join(directory, "catalog")
+        try:
+            FoodCatalog.foods_write(catalog_path, foods)
+        except:
+            shutil.rmtree(directory)
+            raise
+        return catalog_path
+
+    @staticmethod
+    def usda_import(source_path, catalog_path):
+        # Verify argument types:
+        assert isinstance(source_path, str)
+        assert isinstance(catalog_path, str)
 
-            print("[{0:>2}] {1:>5}g{2:>5}g{3:>5}cal  {4:.2f}{5} {6})".
-              format(ingredient_index, int(scaled_food.serving_mass), int(total.serving_mass),
-              int(scaled_food.calories), new_amount, units, description))
-            #print(scaled_food.to_string())
+        # *source_path* is either an unpacked FoodData Central CSV download directory or a
+        # FoodData Central JSON download file:
+        if os.path.isdir(source_path):
+            columns = FoodCatalog._csv_read(source_path)
+        else:
+            columns = FoodCatalog._json_read(source_path)
+        FoodCatalog.write(catalog_path, *columns)
+        return len(columns[2])
 
+    @staticmethod
+    def _csv_read(directory):
+        # Read the FoodData Central CSV files in *directory* a row at a time:
+        def rows(name):
+            with open(os.path.join(directory, name), newline="", encoding="utf-8") as csv_file:
+                for row in csv.DictReader(csv_file):
+                    yield row
 
-        #print("total_grams={0}g scaled_grams={1}g".
-        #  format(int(total_grams), int(total_grams * scale)))
-        print(total.summary_string())
-        print("")
+        # Assign a row to each food:
+        aliases = list()
+        descriptions = list()
+        fdc_rows = dict()
+        for row in rows("food.csv"):
+            fdc_id = int(row["fdc_id"])
+            fdc_rows[fdc_id] = len(descriptions)
+            aliases.append((fdc_id, len(descriptions)))
+            descriptions.append(row["description"])
+        size = len(descriptions)
 
-        #print("<=Recipe.process(*, *, scale={0})".format(scale))
-        return total
+        # Branded foods are also known by their UPC:
+        upcs = list()
+        if os.path.isfile(os.path.join(directory, "branded_food.csv")):
+            for row in rows("branded_food.csv"):
+                food_row = fdc_rows.get(int(row["fdc_id"]))
+                gtin_upc = row["gtin_upc"]
+                if food_row is not None and gtin_upc.isdigit() and len(gtin_upc) <= 14:
+                    upcs.append((upc_normalize(gtin_upc), food_row))
+
+        # Standard Reference foods are also known by their old NDB number:
+        if os.path.isfile(os.path.join(directory, "sr_legacy_food.csv")):
+            for row in rows("sr_legacy_food.csv"):
+                food_row = fdc_rows.get(int(row["fdc_id"]))
+                if food_row is not None and row["NDB_number"].isdigit():
+                    aliases.append((int(row["NDB_number"]), food_row))
+
+        # Fill in the nutrient columns:
+        nutrient_indices = dict()
+        for row in rows("nutrient.csv"):
+            try:
+                number = float(row["nutrient_nbr"])
+            except ValueError:
+                continue
+            if number in USDA_NUTRIENT_NUMBERS:
+                nutrient_indices[row["id"]] = NUTRIENT_NAMES.index(USDA_NUTRIENT_NUMBERS[number])
+        nutrients = numpy.zeros((size, NUTRIENTS_SIZE), dtype=numpy.float64)
+        for row in rows("food_nutrient.csv"):
+            nutrient_index = nutrient_indices.get(row["nutrient_id"])
+            if nutrient_index is not None:
+                food_row = fdc_rows.get(int(row["fdc_id"]))
+                if food_row is not None and row["amount"] != "":
+                    nutrients[food_row, nutrient_index] = float(row["amount"])
+
+        # Collect the serving measures:
+        measures = [list() for index in range(size)]
+        if os.path.isfile(os.path.join(directory, "food_portion.csv")):
+            unit_names = dict()
+            if os.path.isfile(os.path.join(directory, "measure_unit.csv")):
+                for row in rows("measure_unit.csv"):
+                    unit_names[row["id"]] = row["name"]
+            for row in rows("food_portion.csv"):
+                food_row = fdc_rows.get(int(row["fdc_id"]))
+                if food_row is None or row["gram_weight"] == "":
+                    continue
+                label = unit_names.get(row["measure_unit_id"], "undetermined")
+                if label == "undetermined":
+                    label = row["modifier"] or row["portion_description"]
+                amount = float(row["amount"]) if row["amount"] != "" else 1.0
+                measures[food_row].append((amount, units_normalize(label),
+                  float(row["gram_weight"])))
+        return aliases, upcs, descriptions, nutrients, measures
+
+    @staticmethod
+    def _json_read(file_name):
+        with open(file_name, encoding="utf-8") as json_file:
+            document = json.load(json_file)
+
+        # The download has a single top level list (e.g. "FoundationFoods" or "BrandedFoods"):
+        items = list()
+        for value in document.values():
+            if isinstance(value, list):
+                items.extend(value)
+
+        aliases = list()
+        upcs = list()
+        descriptions = list()
+        nutrients = numpy.zeros((len(items), NUTRIENTS_SIZE), dtype=numpy.float64)
+        measures = list()
+        for food_row, item in enumerate(items):
+            aliases.append((int(item["fdcId"]), food_row))
+            ndb_number = str(item.get("ndbNumber", ""))
+            if ndb_number.isdigit():
+                aliases.append((int(ndb_number), food_row))
+            gtin_upc = str(item.get("gtinUpc", ""))
+            if gtin_upc.isdigit() and len(gtin_upc) <= 14:
+                upcs.append((upc_normalize(gtin_upc), food_row))
+            descriptions.append(item["description"])
+            for food_nutrient in item.get("foodNutrients", ()):
+                nutrient = food_nutrient.get("nutrient", dict())
+                try:
+                    number = float(nutrient.get("number", ""))
+                except ValueError:
+                    continue
+                if number in USDA_NUTRIENT_NUMBERS and "amount" in food_nutrient:
+                    nutrient_index = NUTRIENT_NAMES.index(USDA_NUTRIENT_NUMBERS[number])
+                    nutrients[food_row, nutrient_index] = float(food_nutrient["amount"])
+            food_measures = list()
+            for portion in item.get("foodPortions", ()):
+                if "gramWeight" not in portion:
+                    continue
+                label = portion.get("measureUnit", dict()).get("name", "undetermined")
+                if label == "undetermined":
+                    label = portion.get("modifier") or portion.get("portionDescription", "")
+                food_measures.append((float(portion.get("amount", 1.0)), units_normalize(label),
+                  float(portion["gramWeight"])))
+            measures.append(food_measures)
+        return aliases, upcs, descriptions, nutrients, measures
+
+    @staticmethod
+    def write(catalog_path, aliases, upcs, descriptions, nutrients, measures):
+        # Verify argument types:
+        assert isinstance(catalog_path, str)
+        assert isinstance(aliases, list)
+        assert isinstance(upcs, list)
+        assert isinstance(descriptions, list)
+        assert isinstance(nutrients, numpy.ndarray)
+        assert isinstance(measures, list)
+        size = len(descriptions)
+        assert nutrients.shape == (size, NUTRIENTS_SIZE) and len(measures) == size
+
+        # Build the columns.  The first food id given for a row is its FDC id and the first UPC
+        # given for a row is its UPC:
+        row_ids = numpy.full(size, -1, dtype=numpy.int64)
+        for food_id, row in reversed(aliases):
+            row_ids[row] = food_id
+        row_upcs = numpy.full(size, -1, dtype=numpy.int64)
+        for upc, row in reversed(upcs):
+            row_upcs[row] = int(upc)
+        aliases = sorted(set(aliases))
+        id_keys = numpy.array([food_id for food_id, row in aliases], dtype=numpy.int64)
+        id_rows = numpy.array([row for food_id, row in aliases], dtype=numpy.int64)
+        upcs = sorted(dict((int(upc), row) for upc, row in upcs).items())
+        upc_keys = numpy.array([upc for upc, row in upcs], dtype=numpy.int64)
+        upc_rows = numpy.array([row for upc, row in upcs], dtype=numpy.int64)
+        encoded = [description.encode("utf-8") for description in descriptions]
+        description_offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum([len(text) for text in encoded], out=description_offsets[1:])
+        descriptions_column = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+        units = sorted(set(units for food_measures in measures
+          for amount, units, grams in food_measures))
+        unit_indices = {name: index for index, name in enumerate(units)}
+        flat = [measure for food_measures in measures for measure in food_measures]
+        measure_offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum([len(food_measures) for food_measures in measures],
+          out=measure_offsets[1:])
+        columns = {
+          "id_keys":             id_keys,
+          "id_rows":             id_rows,
+          "row_ids":             row_ids,
+          "upc_keys":            upc_keys,
+          "upc_rows":            upc_rows,
+          "row_upcs":            row_upcs,
+          "nutrients":           numpy.ascontiguousarray(nutrients, dtype=numpy.float64),
+          "description_offsets": description_offsets,
+          "descriptions":        descriptions_column,
+          "measure_offsets":     measure_offsets,
+          "measure_amounts":     numpy.array([measure[0] for measure in flat],
+                                   dtype=numpy.float64),
+          "measure_units":       numpy.array([unit_indices[measure[1]] for measure in flat],
+                                   dtype=numpy.int32),
+          "measure_grams":       numpy.array([measure[2] for measure in flat],
+                                   dtype=numpy.float64),
+        }
+        header = {"version": FoodCatalog.LAYOUT_VERSION, "size": size,
+          "nutrient_names": list(NUTRIENT_NAMES), "units": units}
+
+        # Write into a scratch directory and then swap it into place so that readers never
+        # see a partially written catalog:
+        scratch_path = catalog_path + ".new"
+        if os.path.isdir(scratch_path):
+            shutil.rmtree(scratch_path)
+        os.makedirs(scratch_path)
+        for name, column in columns.items():
+            numpy.save(os.path.join(scratch_path, name + ".npy"), column)
+        with open(os.path.join(scratch_path, "catalog.json"), "w") as header_file:
+            json.dump(header, header_file)
+        if os.path.isdir(catalog_path):
+            shutil.rmtree(catalog_path)
+        os.replace(scratch_path, catalog_path)
+
+class FoodResolver:
+    def __init__(self, client, store=None, capacity=10000, catalog=None, search_index=None,
+      scheduler=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(store, FoodStore) or store is None
+        assert isinstance(capacity, int) and capacity > 0
+        assert isinstance(catalog, FoodCatalog) or catalog is None
+        assert isinstance(search_index, FoodSearchIndex) or search_index is None
+        assert isinstance(scheduler, FetchScheduler) or scheduler is None
+
+        # Load up *resolver* (i.e. *self*).  *resolver* is meant to live for the whole process
+        # and be shared by every *Recipe* and *Day* so that each food is only loaded once:
+        resolver = self
+        resolver.client   = client                   # Data source for *store* misses (or *None*)
+        resolver.store    = store                    # The *FoodStore* (*None* for the default)
+        resolver.catalog  = catalog                  # The *FoodCatalog* (*None* for the default)
+        resolver.search_index = search_index         # The *FoodSearchIndex* (*None* for default)
+        resolver.scheduler = scheduler               # Rate limits USDA fetches (or *None*)
+        resolver.capacity = capacity                 # The maximum number of memoized foods
+        resolver.foods    = collections.OrderedDict()  # key => *Food* in LRU order
+        resolver.hits     = 0                        # Lookups answered from *foods*
+        resolver.misses   = 0                        # Lookups that went to *store* or the USDA
+        resolver.lock     = threading.Lock()         # Protects *foods* and the counters
+
+    def catalog_get(self):
+        # Return the offline *FoodCatalog* of *resolver* (i.e. *self*) or *None*:
+        resolver = self
+        catalog = resolver.catalog
+        if catalog is None:
+            catalog = FoodCatalog.default_get()
+        return catalog
+
+    def fetch(self, food_id):
+        # Fetch *food_id* from the USDA, through the *scheduler* of *resolver* (i.e. *self*)
+        # when there is one:
+        resolver = self
+        scheduler = resolver.scheduler
+        if scheduler is not None:
+            return scheduler.fetch(food_id)
+        return Food.fetch(resolver.client, food_id)
+
+    def fetchable(self):
+        # Return *True* if *resolver* (i.e. *self*) has a data source to fetch foods from;
+        # an offline resolver keeps using stale stored foods rather than revalidating them:
+        resolver = self
+        return resolver.client is not None or resolver.scheduler is not None
+
+    def refetch(self, food_id):
+        # Fetch *food_id* again (see *FoodStore.revalidate*) and replace the memoized *Food*:
+        resolver = self
+        food = resolver.fetch(food_id)
+        resolver.insert(food, food_id=food_id)
+        return food
+
+    def ingredient_key_get(self, ingredient):
+        # Return the (food_id, upc) of *ingredient*.  An ingredient that only has a description
+        # is matched against the search index:
+        resolver = self
+        food_id = ingredient.food_id
+        upc = ingredient.upc
+        if food_id is None and upc is None:
+            search_index = resolver.search_index
+            if search_index is None:
+                search_index = FoodSearchIndex.default_get()
+            assert search_index is not None, \
+              "No search index to resolve '{0}'".format(ingredient.description)
+            food_id = search_index.best_match(ingredient.description)
+            assert food_id is not None, "No food matches '{0}'".format(ingredient.description)
+        return food_id, upc
+
+    def clear(self):
+        resolver = self
+        with resolver.lock:
+            resolver.foods.clear()
+            resolver.hits = 0
+            resolver.misses = 0
+
+    def counters_get(self):
+        # Return the hit/miss counters of *resolver* (i.e. *self*) as a *dict*:
+        resolver = self
+        with resolver.lock:
+            counters = {"hits": resolver.hits, "misses": resolver.misses,
+              "size": len(resolver.foods)}
+        return counters
+
+    def insert(self, food, food_id=None, upc=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        # Memoize *food* under *food_id* or *upc*, evicting the least recently used food:
+        resolver = self
+        key = FoodStore.key_get(food_id=food_id, upc=upc)
+        with resolver.lock:
+            foods = resolver.foods
+            foods[key] = food
+            foods.move_to_end(key)
+            while len(foods) > resolver.capacity:
+                foods.popitem(last=False)
+
+    def lookup(self, food_id=None, upc=None):
+        # Return the *Food* for *food_id* or *upc*.  Repeated lookups are a *dict* access.
+        # An inline food defined for *upc* comes first, as it may have been redefined since:
+        resolver = self
+        if upc is not None:
+            food = Food.inline_get(upc)
+            if food is not None:
+                return food
+        key = FoodStore.key_get(food_id=food_id, upc=upc)
+        with resolver.lock:
+            foods = resolver.foods
+            food = foods.get(key)
+            if food is not None:
+                foods.move_to_end(key)
+                resolver.hits += 1
+                Stats.count("resolver_hits")
+                return food
+            resolver.misses += 1
+        Stats.count("resolver_misses")
+
+        # Fall back to the offline catalog, then to *store* and then to the USDA:
+        food = None
+        catalog = resolver.catalog_get()
+        if catalog is not None:
+            food = catalog.food_get(food_id=food_id, upc=upc)
+        if food is not None:
+            resolver.insert(food, food_id=food_id, upc=upc)
+            return food
+        store = resolver.store
+        if store is None:
+            store = FoodStore.default_get()
+        stale = list()
+        food = store.get(food_id=food_id, upc=upc, stale=stale)
+        if food is None:
+            assert not food_id is None, "UPC '{0}' is not in the food store".format(upc)
+            food = resolver.fetch(food_id)
+            store.put(food)
+        elif len(stale) > 0 and resolver.fetchable():
+            store.revalidate(stale, resolver.refetch)
+        resolver.insert(food, food_id=food_id, upc=upc)
+        return food
+
+    def prefetch(self, days, max_workers=8):
+        # Verify argument types:
+        assert isinstance(days, Day) or isinstance(days, list) or isinstance(days, tuple)
+        assert isinstance(max_workers, int) and max_workers > 0
+
+        # Collect the distinct keys of every ingredient in *days* that is not yet memoized:
+        resolver = self
+        if isinstance(days, Day):
+            days = [days]
+        wanted = dict()
+        inline_foods = dict()
+        with resolver.lock:
+            foods = resolver.foods
+            # Walk every recipe of *days*, including sub-recipes, exactly once:
+            recipes = list()
+            for day in days:
+                assert isinstance(day, Day)
+                recipes.extend(recipe for recipe, scale in day.recipe_scale_pairs)
+            visited = set()
+            while len(recipes) > 0:
+                recipe = recipes.pop()
+                if id(recipe) in visited:
+                    continue
+                visited.add(id(recipe))
+                for ingredient in recipe.ingredients:
+                    food = ingredient.food
+                    if ingredient.recipe is not None:
+                        recipes.append(ingredient.recipe)
+                    elif food is not None and food.upc:
+                        inline_foods[upc_normalize(food.upc)] = food
+                    elif food is None:
+                        food_id, upc = resolver.ingredient_key_get(ingredient)
+                        key = FoodStore.key_get(food_id=food_id, upc=upc)
+                        if key not in foods and (upc is None or Food.inline_get(upc) is None):
+                            wanted[key] = (food_id, upc)
+
+        # Anything in the offline catalog needs no I/O at all:
+        catalog = resolver.catalog_get()
+        if catalog is not None:
+            for key, food_id_upc in list(wanted.items()):
+                food_id, upc = food_id_upc
+                food = catalog.food_get(food_id=food_id, upc=upc)
+                if food is not None:
+                    resolver.insert(food, food_id=food_id, upc=upc)
+                    del wanted[key]
+
+        # Inline foods with a UPC are added to the UPC index:
+        if len(inline_foods) > 0:
+            resolver.register(list(inline_foods.values()))
+        for upc in inline_foods:
+            wanted.pop(FoodStore.key_get(upc=upc), None)
+
+        # Load everything that *store* already has with one batched read:
+        store = resolver.store
+        if store is None:
+            store = FoodStore.default_get()
+        stale = list()
+        stored = store.get_many(list(wanted), stale=stale)
+        for key, food in stored.items():
+            food_id, upc = wanted.pop(key)
+            resolver.insert(food, food_id=food_id, upc=upc)
+        if len(stale) > 0 and resolver.fetchable():
+            store.revalidate(stale, resolver.refetch)
+
+        # Fetch the rest from the USDA concurrently, at most *max_workers* at a time.  The foods
+        # that were fetched are stored even when some fetches fail; the first failure is then
+        # raised.  Without a data source, the missing foods are left to be reported when they
+        # are looked up:
+        food_ids = [food_id for food_id, upc in wanted.values() if food_id is not None]
+        if not resolver.fetchable():
+            food_ids = list()
+        fetched = list()
+        failures = list()
+        if len(food_ids) > 0:
+            with concurrent.futures.ThreadPoolExecutor(
+              max_workers=min(max_workers, len(food_ids))) as executor:
+                futures = [executor.submit(resolver.fetch, food_id) for food_id in food_ids]
+                for food_id, future in zip(food_ids, futures):
+                    try:
+                        food = future.result()
+                    except Exception as error:
+                        failures.append(error)
+                        continue
+                    resolver.insert(food, food_id=food_id)
+                    fetched.append(food)
+            store.put_many(fetched)
+        if len(failures) > 0:
+            Stats.count("prefetch_failures", len(failures))
+            raise failures[0]
+        return len(fetched)
+
+    def register(self, foods):
+        # Verify argument types:
+        assert isinstance(foods, list) or isinstance(foods, tuple)
+
+        # Add inline *foods* (e.g. `Food(..., upc=...)`) to *resolver* (i.e. *self*) and to its
+        # *store* so that later ingredients can refer to them by UPC or food id alone:
+        resolver = self
+        for food in foods:
+            assert isinstance(food, Food)
+            if food.upc:
+                Food.inline_add(food)
+                resolver.insert(food, upc=food.upc)
+            if food.food_id is not None and food.food_id >= 0:
+                resolver.insert(food, food_id=food.food_id)
+        store = resolver.store
+        if store is None:
+            store = FoodStore.default_get()
+        store.put_many(list(foods), source=INLINE_SOURCE)
+
+    def resolve(self, ingredient):
+        # Verify argument types:
+        assert isinstance(ingredient, Ingredient)
+
+        # Return the *Food* for *ingredient*; inline foods are returned as is:
+        resolver = self
+        food = ingredient.food
+        if food is None:
+            food_id, upc = resolver.ingredient_key_get(ingredient)
+            food = resolver.lookup(food_id=food_id, upc=upc)
+        return food
+
+class FoodSearchIndex:
+    # The version of the pickled layout written by *FoodSearchIndex.save*():
+    LAYOUT_VERSION = 1
+
+    # The process wide index returned by *FoodSearchIndex.default_get*():
+    default_index = None
+
+    def __init__(self, food_ids, descriptions):
+        # Verify argument types:
+        assert isinstance(food_ids, list)
+        assert isinstance(descriptions, list)
+        assert len(food_ids) == len(descriptions)
+
+        # Split each description into words and build a word => documents inverted index:
+        word_documents = dict()
+        for document, description in enumerate(descriptions):
+            for word in set(FoodSearchIndex.words_get(description)):
+                word_documents.setdefault(word, list()).append(document)
+        words = sorted(word_documents)
+
+        # Index each word by its trigrams so that misspelled query words can be matched:
+        trigram_words = dict()
+        for word_index, word in enumerate(words):
+            for trigram in FoodSearchIndex.trigrams_get(word):
+                trigram_words.setdefault(trigram, list()).append(word_index)
+
+        # Flatten the lists into a few large arrays, which pickle and load quickly:
+        def flatten(lists):
+            offsets = numpy.zeros(len(lists) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(values) for values in lists], out=offsets[1:])
+            values = numpy.fromiter((value for values in lists for value in values),
+              dtype=numpy.int32, count=int(offsets[-1]))
+            return offsets, values
+        trigrams = sorted(trigram_words)
+        posting_offsets, postings = flatten([word_documents[word] for word in words])
+        trigram_offsets, trigram_words = flatten([trigram_words[trigram] for trigram in trigrams])
+
+        # Load up *index* (i.e. *self*):
+        index = self
+        index.food_ids        = food_ids          # The food id of each document
+        index.descriptions    = descriptions      # The description of each document
+        index.words           = words             # Every distinct word in sorted order
+        index.posting_offsets = posting_offsets   # Start of the documents of each word
+        index.postings        = postings          # Documents containing each word
+        index.trigrams        = {trigram: trigram_index  # trigram => index
+                                  for trigram_index, trigram in enumerate(trigrams)}
+        index.trigram_offsets = trigram_offsets   # Start of the words of each trigram
+        index.trigram_words   = trigram_words     # Words containing each trigram
+        index.matches         = dict()            # Memoized *best_match*() results
+
+    @staticmethod
+    def words_get(text):
+        return re.findall(r"[a-z0-9%]+", text.lower())
+
+    @staticmethod
+    def trigrams_get(word):
+        padded = " " + word + " "
+        return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+    @staticmethod
+    def build(catalog=None, store=None):
+        # Verify argument types:
+        assert isinstance(catalog, FoodCatalog) or catalog is None
+        assert isinstance(store, FoodStore) or store is None
+
+        # Collect one (food id, description) pair per food from *catalog* and *store*:
+        food_ids = list()
+        descriptions = list()
+        seen = set()
+        if catalog is not None:
+            id_keys = catalog.id_keys
+            id_rows = catalog.id_rows
+            for row_index in range(len(id_keys)):
+                row = int(id_rows[row_index])
+                if row not in seen:
+                    seen.add(row)
+                    food_ids.append(int(id_keys[row_index]))
+                    descriptions.append(catalog.description_get(row))
+        if store is not None:
+            known = set(food_ids)
+            for food in store.foods_get():
+                food_id = food.food_id
+                if food_id is not None and food_id >= 0 and food_id not in known:
+                    known.add(food_id)
+                    food_ids.append(food_id)
+                    descriptions.append(food.description)
+        return FoodSearchIndex(food_ids, descriptions)
+
+    @staticmethod
+    def default_get():
+        # Return the index at *FOOD_SEARCH_INDEX_PATH* (or *None* if it has not been built):
+        index = FoodSearchIndex.default_index
+        if index is None and os.path.isfile(FOOD_SEARCH_INDEX_PATH):
+            index = FoodSearchIndex.load(FOOD_SEARCH_INDEX_PATH)
+            FoodSearchIndex.default_index = index
+        return index
+
+    @staticmethod
+    def load(path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        with open(path, "rb") as pickle_file:
+            version, index = _FoodUnpickler(pickle_file).load()
+        assert version == FoodSearchIndex.LAYOUT_VERSION, \
+          "Search index '{0}' has layout version {1}".format(path, version)
+        return index
+
+    def save(self, path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        # Write to a scratch file and rename it so that readers never see a partial index:
+        index = self
+        scratch_path = path + ".new"
+        with open(scratch_path, "wb") as pickle_file:
+            pickle.dump((FoodSearchIndex.LAYOUT_VERSION, index), pickle_file,
+              pickle.HIGHEST_PROTOCOL)
+        os.replace(scratch_path, path)
+
+    def __getstate__(self):
+        index = self
+        state = dict(index.__dict__)
+        state["matches"] = dict()
+        return state
+
+    def search(self, query, limit=10):
+        # Verify argument types:
+        assert isinstance(query, str)
+        assert isinstance(limit, int) and limit > 0
+
+        # Score each document of *index* (i.e. *self*) against each word of *query*.  An exact
+        # word match scores highest, then a prefix match, then a fuzzy (trigram) match; rarer
+        # words count for more:
+        index = self
+        words = index.words
+        posting_offsets = index.posting_offsets
+        postings = index.postings
+        trigrams = index.trigrams
+        trigram_offsets = index.trigram_offsets
+        trigram_words = index.trigram_words
+        size = len(index.descriptions)
+        scores = numpy.zeros(size, dtype=numpy.float64)
+        for query_word in FoodSearchIndex.words_get(query):
+            weights = dict()
+            # Prefix matches are a contiguous range of the sorted *words*:
+            start = bisect.bisect_left(words, query_word)
+            end = bisect.bisect_left(words, query_word + "\uffff")
+            for word_index in range(start, min(end, start + 50)):
+                weights[word_index] = 1.0 if words[word_index] == query_word else 0.8
+            # Fuzzy matches share most of their trigrams with *query_word*:
+            query_trigrams = FoodSearchIndex.trigrams_get(query_word)
+            counts = dict()
+            for trigram in query_trigrams:
+                trigram_index = trigrams.get(trigram)
+                if trigram_index is not None:
+                    start = trigram_offsets[trigram_index]
+                    end = trigram_offsets[trigram_index + 1]
+                    for word_index in trigram_words[start:end].tolist():
+                        counts[word_index] = counts.get(word_index, 0) + 1
+            for word_index, count in counts.items():
+                # A padded word of n letters has (at most) n trigrams:
+                word_trigrams = len(words[word_index])
+                similarity = count / float(len(query_trigrams) + word_trigrams - count)
+                if similarity >= 0.4 and word_index not in weights:
+                    weights[word_index] = 0.6 * similarity
+
+            # A document only gets credit for its best match to *query_word*:
+            word_scores = numpy.zeros(size, dtype=numpy.float64)
+            for word_index, weight in weights.items():
+                documents = postings[posting_offsets[word_index]:posting_offsets[word_index + 1]]
+                inverse_frequency = numpy.log(1.0 + size / float(len(documents)))
+                word_scores[documents] = numpy.maximum(word_scores[documents],
+                  weight * inverse_frequency)
+            scores += word_scores
+
+        # Return the best (food_id, description, score) results, with shorter descriptions
+        # winning ties:
+        matched = numpy.flatnonzero(scores > 0.0)
+        if len(matched) > limit * 4:
+            matched = matched[numpy.argpartition(-scores[matched], limit * 4)[:limit * 4]]
+        descriptions = index.descriptions
+        ranked = sorted(matched,
+          key=lambda document: (-scores[document], len(descriptions[document])))[:limit]
+        results = [(index.food_ids[document], descriptions[document], float(scores[document]))
+          for document in ranked]
+        return results
+
+    def best_match(self, description):
+        # Verify argument types:
+        assert isinstance(description, str)
+
+        # Return the food id that best matches *description* (or *None*):
+        index = self
+        matches = index.matches
+        key = description.lower()
+        if key not in matches:
+            results = index.search(description, 1)
+            matches[key] = results[0][0] if len(results) > 0 else None
+        return matches[key]
+
+class FoodSimilarityIndex:
+    # The number of recently inserted foods that are searched by brute force before the
+    # KD-tree is rebuilt to include them:
+    TAIL_SIZE = 4096
+
+    def __init__(self, catalog=None):
+        # Verify argument types:
+        assert isinstance(catalog, FoodCatalog) or catalog is None
+
+        # Load up *index* (i.e. *self*).  Each item is a *Food* or a *catalog* food id:
+        index = self
+        index.catalog   = catalog   # Used to turn food id items into *Food*'s
+        index.items     = list()    # The *Food* or food id of each row
+        index.nutrients = numpy.empty((0, NUTRIENTS_SIZE), dtype=numpy.float64)  # Per 100g
+        index.vectors   = numpy.empty((0, NUTRIENTS_SIZE), dtype=numpy.float64)  # Unit length
+        index.size      = 0         # The number of rows in use (the arrays grow by doubling)
+        index.tree      = None      # A *scipy.spatial.cKDTree* over the first *tree_size* rows
+        index.tree_size = 0
+
+        # Index every food in *catalog*:
+        if catalog is not None:
+            index.rows_insert(catalog.row_ids.tolist(), numpy.asarray(catalog.nutrients))
+
+    @staticmethod
+    def vectors_get(nutrients):
+        # Return the (per 100 gram) *nutrients* rows scaled by *NUTRIENT_REFERENCES* and then
+        # normalized to unit length, so that the Euclidean distance between two rows orders
+        # them the same way as their cosine similarity:
+        vectors = numpy.atleast_2d(nutrients) / NUTRIENT_REFERENCES
+        lengths = numpy.linalg.norm(vectors, axis=1)
+        lengths[lengths == 0.0] = 1.0
+        return vectors / lengths[:, None]
+
+    def insert(self, food):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        index = self
+        index.rows_insert([food], food.nutrients.reshape(1, -1))
+
+    def insert_many(self, foods):
+        # Verify argument types:
+        assert isinstance(foods, list) or isinstance(foods, tuple)
+
+        index = self
+        if len(foods) > 0:
+            index.rows_insert(list(foods), numpy.array([food.nutrients for food in foods]))
+
+    def rows_insert(self, items, nutrients):
+        # Append *items* with their per 100 gram *nutrients* rows to *index* (i.e. *self*):
+        index = self
+        count = len(items)
+        size = index.size
+        if size + count > len(index.nutrients):
+            capacity = max(2 * len(index.nutrients), size + count, 1024)
+            for name in ("nutrients", "vectors"):
+                grown = numpy.empty((capacity, NUTRIENTS_SIZE), dtype=numpy.float64)
+                grown[:size] = getattr(index, name)[:size]
+                setattr(index, name, grown)
+        index.nutrients[size:size + count] = nutrients
+        index.vectors[size:size + count] = FoodSimilarityIndex.vectors_get(nutrients)
+        index.items.extend(items)
+        index.size = size + count
+
+        # Rebuild the tree once the brute force tail gets too long:
+        if index.size - index.tree_size > FoodSimilarityIndex.TAIL_SIZE:
+            index.tree_build()
+
+    def tree_build(self):
+        import scipy.spatial
+
+        index = self
+        index.tree_size = index.size
+        index.tree = scipy.spatial.cKDTree(index.vectors[:index.size].copy())
+
+    def similar(self, food, k=5, constraints=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+        assert isinstance(k, int) and k > 0
+        assert isinstance(constraints, dict) or constraints is None
+
+        # Return up to *k* (*Food*, cosine similarity) pairs from *index* (i.e. *self*) whose
+        # per 100 gram nutrient profile is closest to that of *food*.  *constraints* maps
+        # nutrient names to (minimum, maximum) per 100 grams, either of which may be *None*:
+        index = self
+        query = FoodSimilarityIndex.vectors_get(food.nutrients)[0]
+        def acceptable(rows):
+            # Return a mask of *rows* that satisfy *constraints*:
+            mask = numpy.ones(len(rows), dtype=bool)
+            if constraints is not None:
+                for name, minimum_maximum in constraints.items():
+                    minimum, maximum = minimum_maximum
+                    values = index.nutrients[rows, NUTRIENT_NAMES.index(name)]
+                    if minimum is not None:
+                        mask &= values >= minimum
+                    if maximum is not None:
+                        mask &= values <= maximum
+            return mask
+
+        # Search the tree, asking for more neighbors until enough of them are acceptable (one
+        # extra in case *food* itself is in *index*):
+        candidates = list()
+        tree_size = index.tree_size
+        if tree_size > 0:
+            wanted = k + 1
+            while wanted <= tree_size // 16:
+                distances, rows = index.tree.query(query, wanted)
+                distances = numpy.atleast_1d(distances)
+                rows = numpy.atleast_1d(rows)
+                mask = acceptable(rows)
+                if mask.sum() > k:
+                    break
+                wanted *= 4
+            else:
+                # *constraints* are too selective for the tree, so filter first and then
+                # search the survivors by brute force:
+                rows = numpy.arange(tree_size)
+                rows = rows[acceptable(rows)]
+                distances = numpy.linalg.norm(index.vectors[rows] - query, axis=1)
+                if len(rows) > k + 1:
+                    nearest = numpy.argpartition(distances, k + 1)[:k + 1]
+                    distances = distances[nearest]
+                    rows = rows[nearest]
+                mask = numpy.ones(len(rows), dtype=bool)
+            candidates.extend(zip(distances[mask].tolist(), rows[mask].tolist()))
+
+        # Search the rows inserted since the tree was built by brute force:
+        size = index.size
+        if size > tree_size:
+            rows = numpy.arange(tree_size, size)
+            distances = numpy.linalg.norm(index.vectors[tree_size:size] - query, axis=1)
+            mask = acceptable(rows)
+            candidates.extend(zip(distances[mask].tolist(), rows[mask].tolist()))
+
+        # For unit vectors, `distance ** 2 == 2 - 2 * cosine`:
+        candidates.sort()
+        results = list()
+        for distance, row in candidates:
+            item = index.items[row]
+            if item is food or item == food.food_id:
+                continue
+            if len(results) >= k:
+                break
+            if not isinstance(item, Food) and index.catalog is not None:
+                item = index.catalog.food_get(item)
+            results.append((item, 1.0 - distance * distance / 2.0))
+        return results
+
+class FoodStore:
+    # The version of the SQL schema below.  Bump it whenever the schema or the pickled *Food*
+    # layout changes; stores written with a different version are discarded and refilled:
+    SCHEMA_VERSION = 3
+
+    # The most food ids that can wait for a background revalidation at the same time:
+    REVALIDATE_LIMIT = 1000
+
+    # The most seconds that *revalidations_cancel* waits for a revalidation in progress:
+    REVALIDATE_WAIT = 10.0
+
+    # The process wide store returned by *FoodStore.default_get*():
+    default_store = None
+
+    def __init__(self, path=FOOD_STORE_PATH, ttl=None, max_entries=None, read_only=False,
+      max_age=FOOD_STORE_MAX_AGE, source=USDA_SOURCE_VERSION):
+        # Verify argument types:
+        assert isinstance(path, str)
+        assert isinstance(ttl, float) or isinstance(ttl, int) or ttl is None
+        assert isinstance(max_entries, int) or max_entries is None
+        assert isinstance(read_only, bool)
+        assert isinstance(max_age, float) or isinstance(max_age, int) or max_age is None
+        assert isinstance(source, str)
+
+        # Load up *store* (i.e. *self*).  A *read_only* store never writes to *path*; the
+        # foods it is asked to put are kept in *unwritten* for a writer to store later.
+        # Entries older than *max_age* or from another *source* are still returned, but are
+        # stale and get revalidated in the background (stale-while-revalidate):
+        store = self
+        store.path        = path                # The SQLite data base file name
+        store.ttl         = ttl                 # Seconds before an entry expires (or *None*)
+        store.max_entries = max_entries         # Entries kept before LRU eviction (or *None*)
+        store.read_only   = read_only           # *True* to open *path* read only
+        store.max_age     = max_age             # Seconds before an entry is stale (or *None*)
+        store.source      = source              # The source version of newly fetched foods
+        store.unwritten   = dict()              # source => *Food*'s put into a *read_only* store
+        store.lock        = threading.Lock()    # Serializes the use of *connection*
+        store.connection  = None                # The open *sqlite3.Connection* (or *None*)
+        store.pid         = -1                  # The process id that opened *connection*
+        store.revalidating = set()              # Food ids waiting for (or in) revalidation
+        store.pending     = collections.deque() # (food_id, fetch) pairs waiting to revalidate
+        store.condition   = threading.Condition(store.lock)  # Signals *pending* changes
+        store.revalidator = None                # The daemon thread doing revalidations
+        store.revalidator_pid = -1              # The process id that started *revalidator*
+
+    @staticmethod
+    def default_get():
+        # Return the process wide *FoodStore*, creating it on first use:
+        store = FoodStore.default_store
+        if store is None:
+            store = FoodStore()
+            FoodStore.default_store = store
+        return store
+
+    @staticmethod
+    def key_get(food_id=None, upc=None):
+        # Return the text key used for a *food_id* or *upc*:
+        assert isinstance(food_id, str) or isinstance(food_id, int) or food_id is None
+        assert isinstance(upc, str) or upc is None
+        assert (food_id is None) != (upc is None)
+        return "id:{0}".format(food_id) if upc is None else "upc:{0}".format(upc_normalize(upc))
+
+    def _connection_get(self):
+        # Return the connection for *store* (i.e. *self*), (re)opening it as needed.  A
+        # connection must never be shared across a `fork()`, so a child process opens its own:
+        store = self
+        connection = store.connection
+        pid = os.getpid()
+        if (connection is None or store.pid != pid) and store.read_only:
+            # The writer has already created the schema; a missing or older store is empty:
+            connection = sqlite3.connect("file:{0}?mode=ro".format(store.path), uri=True,
+              timeout=30.0, isolation_level=None, check_same_thread=False)
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != FoodStore.SCHEMA_VERSION:
+                connection.close()
+                connection = sqlite3.connect(":memory:", isolation_level=None,
+                  check_same_thread=False)
+                connection.execute("CREATE TABLE foods (key TEXT PRIMARY KEY, "
+                  "food BLOB NOT NULL, fetched REAL NOT NULL, accessed REAL NOT NULL, "
+                  "source TEXT NOT NULL)")
+            store.connection = connection
+            store.pid = pid
+        elif connection is None or store.pid != pid:
+            connection = sqlite3.connect(store.path, timeout=30.0,
+              isolation_level=None, check_same_thread=False)
+            # Write-ahead logging lets readers in other processes proceed during a write:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != FoodStore.SCHEMA_VERSION:
+                connection.execute("BEGIN IMMEDIATE")
+                version = connection.execute("PRAGMA user_version").fetchone()[0]
+                if version == 2:
+                    # Version 2 had no *source*; its foods are kept, but are all stale:
+                    connection.execute(
+                      "ALTER TABLE foods ADD COLUMN source TEXT NOT NULL DEFAULT ''")
+                elif version != FoodStore.SCHEMA_VERSION:
+                    connection.execute("DROP TABLE IF EXISTS foods")
+                    connection.execute("""CREATE TABLE foods (
+                      key      TEXT PRIMARY KEY,
+                      food     BLOB NOT NULL,
+                      fetched  REAL NOT NULL,
+                      accessed REAL NOT NULL,
+                      source   TEXT NOT NULL)""")
+                    connection.execute("CREATE INDEX foods_accessed ON foods (accessed)")
+                connection.execute("PRAGMA user_version={0}".format(FoodStore.SCHEMA_VERSION))
+                connection.execute("COMMIT")
+            store.connection = connection
+            store.pid = pid
+        return connection
+
+    def close(self):
+        store = self
+        with store.lock:
+            if store.connection is not None and store.pid == os.getpid():
+                store.connection.close()
+            store.connection = None
+
+    def get(self, food_id=None, upc=None, stale=None):
+        # Return the *Food* stored under *food_id* or *upc* (or *None*):
+        store = self
+        key = FoodStore.key_get(food_id=food_id, upc=upc)
+        return store.get_many([key], stale=stale).get(key)
+
+    def get_many(self, keys, stale=None):
+        # Verify argument types:
+        assert isinstance(keys, list) or isinstance(keys, tuple)
+        assert isinstance(stale, list) or stale is None
+
+        # Fetch all of *keys* from *store* (i.e. *self*) using one query per 500 keys and
+        # return a *dict* of the keys that were found.  Expired entries are not returned;
+        # the keys of stale ones are appended to *stale* (if not *None*):
+        store = self
+        ttl = store.ttl
+        now = time.time()
+        stale_fetched = -1.0 if store.max_age is None else now - store.max_age
+        foods = dict()
+        with Stats.timer("cache_read"):
+            with store.lock:
+                connection = store._connection_get()
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    rows = connection.execute(
+                      "SELECT key, food, fetched, source FROM foods WHERE key IN ({0})".
+                      format(",".join("?" * len(chunk))), chunk).fetchall()
+                    for key, blob, fetched, source in rows:
+                        if ttl is None or now - fetched <= ttl:
+                            foods[key] = pickle_loads(blob)
+                            if stale is not None and source != INLINE_SOURCE and \
+                              (source != store.source or fetched < stale_fetched):
+                                stale.append(key)
+
+                # Record the access time, which drives the LRU eviction:
+                if len(foods) > 0 and store.max_entries is not None and not store.read_only:
+                    connection.executemany("UPDATE foods SET accessed = ? WHERE key = ?",
+                      [(now, key) for key in foods])
+        Stats.count("cache_hits", len(foods))
+        Stats.count("cache_misses", len(keys) - len(foods))
+        return foods
+
+    def put(self, food, source=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        store = self
+        store.put_many([food], source=source)
+
+    def put_many(self, foods, source=None):
+        # Verify argument types:
+        assert isinstance(foods, list) or isinstance(foods, tuple)
+        assert isinstance(source, str) or source is None
+
+        # Store each *Food* in *foods* under its *food_id* and its *upc* in one transaction.
+        # *source* defaults to the *source* of *store* (i.e. *self*), which is right for foods
+        # fetched from the USDA; use *INLINE_SOURCE* for anything else:
+        store = self
+        source = store.source if source is None else source
+        if store.read_only:
+            with store.lock:
+                store.unwritten.setdefault(source, list()).extend(foods)
+            return
+        with Stats.timer("cache_write"):
+            now = time.time()
+            rows = list()
+            for food in foods:
+                assert isinstance(food, Food)
+                blob = pickle.dumps(food, pickle.HIGHEST_PROTOCOL)
+                food_id = food.food_id
+                if food_id is not None and food_id >= 0:
+                    rows.append((FoodStore.key_get(food_id=food_id), blob, now, now, source))
+                if food.upc:
+                    rows.append((FoodStore.key_get(upc=food.upc), blob, now, now, source))
+            if len(rows) > 0:
+                with store.lock:
+                    connection = store._connection_get()
+                    connection.execute("BEGIN IMMEDIATE")
+                    try:
+                        connection.executemany(
+                          "INSERT OR REPLACE INTO foods (key, food, fetched, accessed, source) "
+                          "VALUES (?, ?, ?, ?, ?)", rows)
+                        store._evict(connection, now)
+                        connection.execute("COMMIT")
+                    except:
+                        connection.execute("ROLLBACK")
+                        raise
+
+    def foods_get(self, fresh=False):
+        # Return every (unexpired) *Food* in *store* (i.e. *self*) that is keyed by food id,
+        # leaving out the stale ones (see *get_many*) if *fresh* is *True*:
+        store = self
+        ttl = store.ttl
+        now = time.time()
+        stale_fetched = -1.0 if store.max_age is None else now - store.max_age
+        foods = list()
+        with store.lock:
+            connection = store._connection_get()
+            rows = connection.execute(
+              "SELECT food, fetched, source FROM foods WHERE key LIKE 'id:%'").fetchall()
+        for blob, fetched, source in rows:
+            if ttl is None or now - fetched <= ttl:
+                if fresh and source != INLINE_SOURCE and \
+                  (source != store.source or fetched < stale_fetched):
+                    continue
+                foods.append(pickle_loads(blob))
+        return foods
+
+    def revalidate(self, keys, fetch):
+        # Verify argument types:
+        assert isinstance(keys, list) or isinstance(keys, tuple)
+
+        # Re-fetch the foods of the stale `id:` *keys* (from *get_many*) on a background thread
+        # with *fetch* (e.g. *FoodResolver.fetch*) and put them into *store* (i.e. *self*).
+        # Nothing waits for this; the stale foods are used until the fresh ones arrive.  The
+        # thread is a daemon, so exiting drops the revalidations that have not finished yet
+        # (they are still stale the next time around):
+        store = self
+        pid = os.getpid()
+        count = 0
+        with store.condition:
+            if store.revalidator_pid != pid:
+                # A forked child does not inherit the thread doing the revalidations:
+                store.revalidating.clear()
+                store.pending.clear()
+                store.revalidator = None
+            revalidating = store.revalidating
+            for key in keys:
+                if key.startswith("id:") and key not in revalidating and \
+                  len(revalidating) < FoodStore.REVALIDATE_LIMIT:
+                    revalidating.add(key)
+                    store.pending.append((int(key[3:]), fetch))
+                    count += 1
+            if count > 0:
+                if store.revalidator is None:
+                    store.revalidator = threading.Thread(target=store._revalidations_run,
+                      name="FoodStore.revalidate", daemon=True)
+                    store.revalidator_pid = pid
+                    store.revalidator.start()
+                store.condition.notify_all()
+        Stats.count("revalidations", count)
+
+    def revalidations_cancel(self, timeout=None):
+        # Verify argument types:
+        assert isinstance(timeout, float) or isinstance(timeout, int) or timeout is None
+
+        # Drop the revalidations of *store* (i.e. *self*) that have not started and wait at most
+        # *timeout* seconds (default *REVALIDATE_WAIT*) for the one in progress to finish.
+        # Return the number of revalidations that were dropped:
+        store = self
+        timeout = FoodStore.REVALIDATE_WAIT if timeout is None else timeout
+        with store.condition:
+            if store.revalidator_pid != os.getpid():
+                return 0
+            dropped = len(store.pending)
+            for food_id, fetch in store.pending:
+                store.revalidating.discard(FoodStore.key_get(food_id=food_id))
+            store.pending.clear()
+            store.condition.wait_for(lambda: len(store.revalidating) == 0, timeout)
+        Stats.count("revalidations_dropped", dropped)
+        return dropped
+
+    def _revalidations_run(self):
+        # Revalidate the *pending* foods of *store* (i.e. *self*) one at a time, forever:
+        store = self
+        while True:
+            with store.condition:
+                store.condition.wait_for(lambda: len(store.pending) > 0)
+                food_id, fetch = store.pending.popleft()
+            store._revalidate(food_id, fetch)
+
+    def _revalidate(self, food_id, fetch):
+        # Re-fetch *food_id* into *store* (i.e. *self*); on an error the stale food is kept
+        # and revalidated again the next time that it is used:
+        store = self
+        try:
+            store.put(fetch(food_id))
+        except Exception:
+            Stats.count("revalidation_failures")
+        finally:
+            with store.condition:
+                store.revalidating.discard(FoodStore.key_get(food_id=food_id))
+                store.condition.notify_all()
+
+    def refresh(self, fetch, max_age=None, budget=200, max_workers=4):
+        # Verify argument types:
+        assert isinstance(max_age, float) or isinstance(max_age, int) or max_age is None
+        assert isinstance(budget, int) and budget >= 0
+        assert isinstance(max_workers, int) and max_workers > 0
+
+        # Re-fetch the stale USDA foods in *store* (i.e. *self*), oldest first, with *fetch*
+        # (e.g. *FetchScheduler.fetch*) using at most *budget* USDA requests (two per food).
+        # *max_age* defaults to the *max_age* of *store*.  Return a *dict* of how many foods
+        # were refreshed, how many failed and how many stale foods are left for next time:
+        store = self
+        max_age = store.max_age if max_age is None else max_age
+        stale_fetched = -1.0 if max_age is None else time.time() - max_age
+        stale_where = ("FROM foods WHERE key LIKE 'id:%' AND source != ? AND "
+          "(source != ? OR fetched < ?)")
+        arguments = (INLINE_SOURCE, store.source, stale_fetched)
+        with store.lock:
+            connection = store._connection_get()
+            keys = [key for key, in connection.execute(
+              "SELECT key " + stale_where + " ORDER BY fetched LIMIT ?",
+              arguments + (budget // 2,)).fetchall()]
+        food_ids = [int(key[3:]) for key in keys]
+        foods = list()
+        failed = 0
+        if len(food_ids) > 0:
+            with concurrent.futures.ThreadPoolExecutor(
+              max_workers=min(max_workers, len(food_ids))) as executor:
+                futures = [executor.submit(fetch, food_id) for food_id in food_ids]
+                for future in futures:
+                    try:
+                        foods.append(future.result())
+                    except Exception:
+                        failed += 1
+            store.put_many(foods)
+        with store.lock:
+            remaining = connection.execute(
+              "SELECT COUNT(*) " + stale_where, arguments).fetchone()[0]
+        return {"refreshed": len(foods), "failed": failed, "stale": remaining}
+
+    def evict(self):
+        # Remove expired and least recently used entries from *store* (i.e. *self*):
+        store = self
+        if store.read_only:
+            return
+        with store.lock:
+            connection = store._connection_get()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                store._evict(connection, time.time())
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self, connection, now):
+        # Evict entries from *store* (i.e. *self*) inside an already open transaction:
+        store = self
+        ttl = store.ttl
+        if ttl is not None:
+            connection.execute("DELETE FROM foods WHERE fetched < ?", (now - ttl,))
+        max_entries = store.max_entries
+        if max_entries is not None:
+            connection.execute("DELETE FROM foods WHERE key IN "
+              "(SELECT key FROM foods ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+              (max_entries,))
+
+class _FoodUnpickler(pickle.Unpickler):
+    # Read back pickles written when `food.py` was run as `__main__` (before `main` was run
+    # from the `food` module) with the classes of this module:
+    def find_class(self, module, name):
+        if module == "__main__":
+            module = __name__
+        return pickle.Unpickler.find_class(self, module, name)
+
+def pickle_loads(data):
+    # Return the object pickled in *data* (see *_FoodUnpickler*):
+    return _FoodUnpickler(io.BytesIO(data)).load()
+
+class Ingredient:
+    __slots__ = ("amount", "units", "description", "food_id", "upc", "food", "recipe",
+      "grams_per_unit")
+
+    # Conversion coefficients to milliLiters:
+    def __init__(self, amount, units, description, food_id=None, upc=None, food=None,
+      recipe=None):
+        # Verifya argument types:
+        assert isinstance(amount, float)
+        assert isinstance(units, str)
+        assert isinstance(description, str)
+        assert isinstance(food_id, str) or isinstance(food_id, int) or food_id is None
+        assert isinstance(upc, str) or upc is None
+        assert isinstance(food, Food) or food is None
+        assert isinstance(recipe, Recipe) or recipe is None
+        count = 0
+        count += isinstance(food_id, str) or isinstance(food_id, int)
+        count += isinstance(upc, str)
+        count += isinstance(food, Food)
+        count += isinstance(recipe, Recipe)
+        assert count <= 1  # With none of them, the food is found by *description*
+
+        # Load arguments into *ingredient* (i.e. *self*):
+        ingredient = self
+        ingredient.amount      = float(amount)
+        ingredient.units       = units.lower()
+        ingredient.description = description
+        ingredient.food_id     = food_id
+        ingredient.upc         = upc
+        ingredient.food        = food
+        ingredient.recipe      = recipe   # A sub-recipe used as the food (or *None*)
+        ingredient.grams_per_unit = None  # Grams per one *units*, once *food* is known
+        if food is not None:
+            ingredient.grams_per_unit_get(food)
+
+    @staticmethod
+    def _validated(amount, units, description, food_id, upc, food, recipe):
+        # Create an *Ingredient* from arguments that have already been validated (e.g. by
+        # *Recipe.ingredient*); *amount* must be a *float* and *units* lower case:
+        ingredient = Ingredient.__new__(Ingredient)
+        ingredient.amount         = amount
+        ingredient.units          = units
+        ingredient.description    = description
+        ingredient.food_id        = food_id
+        ingredient.upc            = upc
+        ingredient.food           = food
+        ingredient.recipe         = recipe
+        ingredient.grams_per_unit = None
+        return ingredient
+
+    def __getstate__(self):
+        # Pickle as a *dict*, just like before *Ingredient* had `__slots__`:
+        ingredient = self
+        return {name: getattr(ingredient, name) for name in Ingredient.__slots__}
+
+    def __setstate__(self, state):
+        ingredient = self
+        for name in Ingredient.__slots__:
+            setattr(ingredient, name, state.get(name))
+
+    def grams_per_unit_get(self, food):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        # The conversion from *units* to grams is worked out once per *ingredient*
+        # (i.e. *self*) and then reused:
+        ingredient = self
+        grams_per_unit = ingredient.grams_per_unit
+        if grams_per_unit is None:
+            with Stats.timer("conversion"):
+                grams_per_unit = food.grams_per_unit_get(ingredient.units)
+            ingredient.grams_per_unit = grams_per_unit
+        return grams_per_unit
+
+    def grams_get(self, food):
+        # Verify argument types:
+        assert isinstance(food, Food)
+
+        # Convert the *amount* and *units* of *ingredient* (i.e. *self*) into grams of *food*:
+        ingredient = self
+        return ingredient.amount * ingredient.grams_per_unit_get(food)
+
+    def food_lookup(self, client=None, store=None, resolver=None, catalog=None):
+        #print("=>Ingredient.food_lookup(*)")
+
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(store, FoodStore) or store is None
+        assert isinstance(resolver, FoodResolver) or resolver is None
+        assert isinstance(catalog, FoodCatalog) or catalog is None
+
+        # Grap the *food_id* from *ingredient* (i.e. *self*):
+        ingredient = self
+
+        # A sub-recipe is evaluated (once) into a per 100 gram *Food*:
+        if ingredient.recipe is not None:
+            return ingredient.recipe.food_get(client, resolver=resolver)
+
+        # A shared *resolver* memoizes foods across every *Recipe* and *Day*:
+        if resolver is not None:
+            return resolver.resolve(ingredient)
+
+        # An ingredient with only a description is matched against the search index:
+        food = ingredient.food
+        food_id = ingredient.food_id
+        upc = ingredient.upc
+        if food is None and food_id is None and upc is None:
+            search_index = FoodSearchIndex.default_get()
+            assert search_index is not None, \
+              "No search index to resolve '{0}'".format(ingredient.description)
+            food_id = search_index.best_match(ingredient.description)
+            assert food_id is not None, "No food matches '{0}'".format(ingredient.description)
+
+        # Inline foods need no lookup, including those defined for *upc* elsewhere; everything
+        # else is looked up in the offline *catalog* and then in *store* before going to the
+        # USDA:
+        if food is None and upc is not None:
+            food = Food.inline_get(upc)
+        if food is None:
+            if catalog is None:
+                catalog = FoodCatalog.default_get()
+            if catalog is not None:
+                food = catalog.food_get(food_id=food_id, upc=upc)
+                if food is not None:
+                    return food
+        if food is None:
+            if store is None:
+                store = FoodStore.default_get()
+            stale = list()
+            food = store.get(food_id=food_id, upc=upc, stale=stale)
+            if len(stale) > 0 and client is not None:
+                store.revalidate(stale, lambda food_id: Food.fetch(client, food_id))
+        if food is None:
+            assert not food_id is None, "UPC '{0}' is not in the food store".format(upc)
+            food = Food.fetch(client, food_id)
+            store.put(food)
+
+        #print("<=Ingredient.food_lookup(*)")
+        return food
+
+class JsonLinesRenderer(BufferedRenderer):
+    def recipe(self, report):
+        # Verify argument types:
+        assert isinstance(report, RecipeReport)
+
+        # Write *report* as a single JSON object on one line:
+        renderer = self
+        ingredients = [{
+          "index": ingredient.index,
+          "amount": ingredient.amount,
+          "units": ingredient.units,
+          "description": ingredient.description,
+          "grams": ingredient.grams,
+          "nutrients": dict(zip(NUTRIENT_NAMES, ingredient.nutrients.tolist())),
+        } for ingredient in report.ingredients]
+        renderer.write(json.dumps({
+          "recipe": report.name,
+          "scale": report.scale,
+          "grams": report.grams,
+          "nutrients": dict(zip(NUTRIENT_NAMES, report.nutrients.tolist())),
+          "ingredients": ingredients,
+        }) + "\n")
+
+    def food(self, food, heading=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+        assert isinstance(heading, str) or heading is None
+
+        renderer = self
+        renderer.write(json.dumps({
+          "heading": heading,
+          "food": food.description,
+          "grams": food.serving_mass,
+          "nutrients": dict(zip(NUTRIENT_NAMES, food.nutrients.tolist())),
+        }) + "\n")
+
+    def error(self, message, heading=None):
+        # Verify argument types:
+        assert isinstance(message, str)
+        assert isinstance(heading, str) or heading is None
+
+        renderer = self
+        renderer.write(json.dumps({"heading": heading, "error": message}) + "\n")
+
+class MealLog:
+    # The version of the on disk layout of a *MealLog* directory (version 1 had no
+    # `index.log`, so it can still be read):
+    LAYOUT_VERSION = 2
+
+    # New user day keys go into a small sorted delta index (and are appended to `index.log`)
+    # that is only merged into the main index once it holds a quarter as many keys (or at
+    # least this many), so the cost of an append is proportional to what it adds:
+    DELTA_MINIMUM = 1 << 16
+
+    # Each user day row holds the *NUTRIENT_NAMES* totals followed by the total grams:
+    COLUMNS = NUTRIENTS_SIZE + 1
+
+    # A user day key is `(user_index << DAY_BITS) | date.toordinal()`:
+    DAY_BITS = 24
+
+    def __init__(self, path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        # Open (or create) the meal log directory at *path*.  It holds:
+        #   log.json    The header (layout version, user day rows and how many are merged)
+        #   users.txt   One user name per line; the line number is the user index
+        #   totals.dat  A memory-mapped rows x *COLUMNS* float64 array of user day totals
+        #   keys.npy    The sorted user day keys that have been merged and...
+        #   rows.npy    ...the row in *totals.dat* of each key
+        #   index.log   The (key, row) int64 pairs added since the last merge
+        os.makedirs(path, exist_ok=True)
+        header_path = os.path.join(path, "log.json")
+        size = 0
+        merged = 0
+        if os.path.isfile(header_path):
+            with open(header_path) as header_file:
+                header = json.load(header_file)
+            assert header["version"] in (1, MealLog.LAYOUT_VERSION), \
+              "Meal log '{0}' has layout version {1}".format(path, header["version"])
+            assert tuple(header["nutrient_names"]) == NUTRIENT_NAMES
+            size = header["size"]
+            merged = header.get("merged", size)
+        users = list()
+        users_path = os.path.join(path, "users.txt")
+        if os.path.isfile(users_path):
+            with open(users_path) as users_file:
+                users = [line.rstrip("\n") for line in users_file]
+        keys = numpy.zeros(0, dtype=numpy.int64)
+        rows = numpy.zeros(0, dtype=numpy.int64)
+        if size > 0 and os.path.isfile(os.path.join(path, "keys.npy")):
+            keys = numpy.load(os.path.join(path, "keys.npy"))
+            rows = numpy.load(os.path.join(path, "rows.npy"))
+            assert len(keys) == len(rows)
+            if len(keys) != merged:
+                # A merge was written but its header was not; it holds every row the header
+                # knows about (and maybe some that it does not), so `index.log` is not needed:
+                keep = rows < size
+                keys = keys[keep]
+                rows = rows[keep]
+                assert len(keys) == size
+                merged = size
+
+        # Read the delta index back from `index.log`, dropping anything that an interrupted
+        # *flush* wrote after the header was last updated:
+        pairs = numpy.zeros((0, 2), dtype=numpy.int64)
+        index_log_path = os.path.join(path, "index.log")
+        if os.path.isfile(index_log_path):
+            pairs = numpy.fromfile(index_log_path, dtype=numpy.int64,
+              count=2 * (size - merged)).reshape(-1, 2)
+            os.truncate(index_log_path, pairs.nbytes)
+        assert len(pairs) == size - merged
+        order = numpy.argsort(pairs[:, 0], kind="stable")
+
+        # Load up *log* (i.e. *self*):
+        log = self
+        log.path         = path
+        log.size         = size                 # The number of user day rows in use
+        log.users        = users                # User index => user name
+        log.user_indices = {user: index for index, user in enumerate(users)}
+        log.users_saved  = len(users)           # The number of *users* in *users.txt*
+        log.keys         = keys                 # Sorted merged user day keys
+        log.rows         = rows                 # The *totals* row of each of *keys*
+        log.delta_keys   = pairs[order, 0]      # Sorted user day keys since the last merge
+        log.delta_rows   = pairs[order, 1]      # The *totals* row of each of *delta_keys*
+        log.merged       = merged               # The number of *keys* saved in `keys.npy`
+        log.logged       = size                 # The number of rows saved in `index.log`
+        log.totals       = None                 # The *numpy.memmap* of *totals.dat*
+        log._totals_open(max(size, 1024))
+
+    def _totals_open(self, capacity):
+        # (Re)map *totals.dat* of *log* (i.e. *self*) with room for at least *capacity* rows:
+        log = self
+        totals_path = os.path.join(log.path, "totals.dat")
+        row_bytes = MealLog.COLUMNS * 8
+        current = os.path.getsize(totals_path) // row_bytes if os.path.isfile(totals_path) else 0
+        if log.totals is not None:
+            log.totals.flush()
+            log.totals = None
+        if current < capacity:
+            with open(totals_path, "ab") as totals_file:
+                totals_file.truncate(capacity * row_bytes)
+            current = capacity
+        log.totals = numpy.memmap(totals_path, dtype=numpy.float64, mode="r+",
+          shape=(current, MealLog.COLUMNS))
+
+    @staticmethod
+    def ordinal_get(date):
+        # Return the day number of *date* (a *datetime.date* or a "YYYY-MM-DD" *str*):
+        if isinstance(date, str):
+            date = datetime.date.fromisoformat(date[:10])
+        assert isinstance(date, datetime.date)
+        return date.toordinal()
+
+    def user_index_get(self, user):
+        # Return the index of *user* in *log* (i.e. *self*), adding it if it is new:
+        log = self
+        user = str(user)
+        index = log.user_indices.get(user)
+        if index is None:
+            assert "\n" not in user
+            index = len(log.users)
+            log.users.append(user)
+            log.user_indices[user] = index
+        return index
+
+    def append(self, records, client=None, resolver=None, chunk_size=100000):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+        assert isinstance(chunk_size, int) and chunk_size > 0
+
+        # Add *records*, an iterable of (user, date, item, scale) tuples, to the daily totals
+        # of *log* (i.e. *self*).  An item is a *Recipe* (*scale* times its total) or a *Food*
+        # (*scale* servings).  *records* is consumed *chunk_size* records at a time, so memory
+        # stays bounded however long it is, and only the user days it touches are updated:
+        log = self
+        item_indices = dict()      # id(item) => row of *item_vectors* (for this chunk)
+        items = list()             # Keeps the *item_indices* items (and so their ids) alive
+        item_vectors = list()      # The unscaled nutrients and grams of each item
+        ordinals = dict()          # Date => ordinal, since most records share a few dates
+        chunk = list()
+        count = 0
+        for record in records:
+            user, date, item, scale = record
+            item_index = item_indices.get(id(item))
+            if item_index is None:
+                vector = numpy.empty(MealLog.COLUMNS, dtype=numpy.float64)
+                if isinstance(item, Recipe):
+                    matrix, grams, recipe_vector = item.compile(client, resolver=resolver)
+                    vector[:NUTRIENTS_SIZE] = recipe_vector
+                    vector[NUTRIENTS_SIZE] = item.mass
+                else:
+                    assert isinstance(item, Food), "Bad meal log item {0!r}".format(item)
+                    vector[:NUTRIENTS_SIZE] = item.nutrients * (item.serving_mass / 100.0)
+                    vector[NUTRIENTS_SIZE] = item.serving_mass
+                item_index = len(item_vectors)
+                item_indices[id(item)] = item_index
+                items.append(item)
+                item_vectors.append(vector)
+            ordinal = ordinals.get(date)
+            if ordinal is None:
+                ordinal = MealLog.ordinal_get(date)
+                ordinals[date] = ordinal
+            chunk.append((log.user_index_get(user), ordinal, item_index, scale))
+            if len(chunk) >= chunk_size:
+                log._chunk_add(chunk, numpy.array(item_vectors))
+                count += len(chunk)
+                chunk = list()
+                item_indices.clear()
+                del items[:]
+                del item_vectors[:]
+        if len(chunk) > 0:
+            log._chunk_add(chunk, numpy.array(item_vectors))
+            count += len(chunk)
+        log.flush()
+        return count
+
+    def _chunk_add(self, chunk, item_vectors):
+        # Add a *chunk* of (user_index, ordinal, item_index, scale) tuples to *log* (i.e.
+        # *self*).  The chunk is first summed per user day, then added to existing rows or
+        # appended as new rows:
+        log = self
+        columns = numpy.array(chunk, dtype=numpy.float64).T
+        chunk_keys = ((columns[0].astype(numpy.int64) << MealLog.DAY_BITS) |
+          columns[1].astype(numpy.int64))
+        vectors = item_vectors[columns[2].astype(numpy.int64)] * columns[3][:, None]
+        unique_keys, sums = MealLog._keys_sum(chunk_keys, vectors)
+
+        # Add the user days that already have a row:
+        rows = log.rows_find(unique_keys)
+        found = rows >= 0
+        if found.any():
+            log.totals[rows[found]] += sums[found]
+
+        # Append the new user days to the delta index:
+        new = ~found
+        new_count = int(new.sum())
+        if new_count > 0:
+            size = log.size
+            if size + new_count > len(log.totals):
+                log._totals_open(max(2 * len(log.totals), size + new_count))
+            new_rows = numpy.arange(size, size + new_count, dtype=numpy.int64)
+            log.totals[size:size + new_count] = sums[new]
+            positions = numpy.searchsorted(log.delta_keys, unique_keys[new])
+            log.delta_keys = numpy.insert(log.delta_keys, positions, unique_keys[new])
+            log.delta_rows = numpy.insert(log.delta_rows, positions, new_rows)
+            log.size = size + new_count
+
+    def rows_find(self, keys):
+        # Return the *totals* row of each of the sorted *keys* in *log* (i.e. *self*), or -1
+        # for the keys that it does not have:
+        log = self
+        rows = numpy.full(len(keys), -1, dtype=numpy.int64)
+        for index_keys, index_rows in ((log.keys, log.rows), (log.delta_keys, log.delta_rows)):
+            positions = numpy.searchsorted(index_keys, keys)
+            found = positions < len(index_keys)
+            found[found] = index_keys[positions[found]] == keys[found]
+            rows[found] = index_rows[positions[found]]
+        return rows
+
+    def _merge(self):
+        # Merge the delta index of *log* (i.e. *self*) into its main index:
+        log = self
+        keys = numpy.concatenate((log.keys, log.delta_keys))
+        order = numpy.argsort(keys, kind="stable")
+        log.keys = keys[order]
+        log.rows = numpy.concatenate((log.rows, log.delta_rows))[order]
+        log.delta_keys = numpy.zeros(0, dtype=numpy.int64)
+        log.delta_rows = numpy.zeros(0, dtype=numpy.int64)
+
+    def flush(self):
+        # Write everything in *log* (i.e. *self*) to disk; the header is written last so that
+        # an interrupted flush leaves the previous state readable:
+        log = self
+        path = log.path
+        log.totals.flush()
+        if len(log.users) > log.users_saved:
+            with open(os.path.join(path, "users.txt"), "a") as users_file:
+                for user in log.users[log.users_saved:]:
+                    users_file.write(user + "\n")
+            log.users_saved = len(log.users)
+
+        # Only the rows added since the last flush are appended to `index.log`, until the
+        # delta index is large enough to be worth merging and rewriting the main index:
+        index_log_path = os.path.join(path, "index.log")
+        if len(log.delta_keys) > max(MealLog.DELTA_MINIMUM, len(log.keys) // 4):
+            log._merge()
+            for name, array in (("keys", log.keys), ("rows", log.rows)):
+                scratch_path = os.path.join(path, "{0}.{1}.npy".format(name, os.getpid()))
+                numpy.save(scratch_path, array)
+                os.replace(scratch_path, os.path.join(path, name + ".npy"))
+            log.merged = len(log.keys)
+        elif log.size > log.logged:
+            # The new rows are the last ones, so they are found by row rather than by key:
+            new = log.delta_rows >= log.logged
+            pairs = numpy.stack((log.delta_keys[new], log.delta_rows[new]), axis=1)
+            with open(index_log_path, "ab") as index_log_file:
+                index_log_file.write(pairs[numpy.argsort(pairs[:, 1])].tobytes())
+        log.logged = log.size
+        header = {
+          "version": MealLog.LAYOUT_VERSION,
+          "nutrient_names": NUTRIENT_NAMES,
+          "size": log.size,
+          "merged": log.merged,
+        }
+        scratch_path = os.path.join(path, "log.json.{0}".format(os.getpid()))
+        with open(scratch_path, "w") as header_file:
+            json.dump(header, header_file)
+        os.replace(scratch_path, os.path.join(path, "log.json"))
+        if log.merged == log.size and os.path.isfile(index_log_path):
+            os.truncate(index_log_path, 0)
+
+    def day_get(self, user, date):
+        # Return the nutrients and grams logged by *user* on *date* (zeros if nothing was):
+        log = self
+        totals = numpy.zeros(MealLog.COLUMNS, dtype=numpy.float64)
+        index = log.user_indices.get(str(user))
+        if index is not None:
+            key = (index << MealLog.DAY_BITS) | MealLog.ordinal_get(date)
+            row = int(log.rows_find(numpy.array([key], dtype=numpy.int64))[0])
+            if row >= 0:
+                totals[:] = log.totals[row]
+        return totals
+
+    def rollup(self, period="week", cohorts=None, chunk_size=1 << 20):
+        # Verify argument types:
+        assert period in ("day", "week", "month")
+        assert isinstance(cohorts, dict) or cohorts is None
+        assert isinstance(chunk_size, int) and chunk_size > 0
+
+        # Sum the user day totals of *log* (i.e. *self*) per *period* and per user (or per
+        # cohort when *cohorts* maps user names to cohort names; other users are skipped).
+        # Return (*names*, *groups*, *starts*, *totals*), where row i of *totals* is for the
+        # group *names*[*groups*[i]] in the *period* starting on day ordinal *starts*[i].  The
+        # rows are streamed in *chunk_size* pieces, so only the result is held in memory:
+        log = self
+        if cohorts is None:
+            names = log.users
+            user_groups = None
+        else:
+            names = sorted(set(cohorts.values()))
+            name_indices = {name: index for index, name in enumerate(names)}
+            user_groups = numpy.array([name_indices.get(cohorts.get(user), -1)
+              for user in log.users], dtype=numpy.int64)
+
+        chunk_results = list()
+        day_mask = (1 << MealLog.DAY_BITS) - 1
+        pieces = [(index_keys[start:start + chunk_size], index_rows[start:start + chunk_size])
+          for index_keys, index_rows in ((log.keys, log.rows), (log.delta_keys, log.delta_rows))
+          for start in range(0, len(index_keys), chunk_size)]
+        for keys, rows in pieces:
+            groups = keys >> MealLog.DAY_BITS
+            if user_groups is not None:
+                groups = user_groups[groups]
+            ordinals = keys & day_mask
+            if period == "week":
+                # `date.fromordinal(1)` is a Monday, so weeks start on Mondays:
+                ordinals = ordinals - (ordinals - 1) % 7
+            elif period == "month":
+                epoch = datetime.date(1970, 1, 1).toordinal()
+                months = (ordinals - epoch).astype("datetime64[D]").astype("datetime64[M]")
+                ordinals = months.astype("datetime64[D]").astype(numpy.int64) + epoch
+            keep = groups >= 0
+            chunk_keys = (groups[keep] << MealLog.DAY_BITS) | ordinals[keep]
+            chunk_results.append(MealLog._keys_sum(chunk_keys, log.totals[rows[keep]]))
+
+        # Combine the groups that straddle chunks:
+        result_keys = numpy.zeros(0, dtype=numpy.int64)
+        totals = numpy.zeros((0, MealLog.COLUMNS), dtype=numpy.float64)
+        if len(chunk_results) > 0:
+            result_keys, totals = MealLog._keys_sum(
+              numpy.concatenate([keys for keys, sums in chunk_results]),
+              numpy.concatenate([sums for keys, sums in chunk_results]))
+        return names, result_keys >> MealLog.DAY_BITS, result_keys & day_mask, totals
+
+    @staticmethod
+    def _keys_sum(keys, values):
+        # Return the sorted unique *keys* and the sum of the *values* rows for each of them:
+        unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+        sums = numpy.empty((len(unique_keys), MealLog.COLUMNS), dtype=numpy.float64)
+        for column in range(MealLog.COLUMNS):
+            sums[:, column] = numpy.bincount(inverse, weights=values[:, column],
+              minlength=len(unique_keys))
+        return unique_keys, sums
+
+class MealPlanner:
+    def __init__(self, candidates):
+        # Verify argument types:
+        assert isinstance(candidates, list) or isinstance(candidates, tuple)
+        for candidate in candidates:
+            assert isinstance(candidate, Recipe) or isinstance(candidate, Food)
+
+        # Load up *planner* (i.e. *self*).  Each candidate is given a scale: for a *Recipe*
+        # it is the usual meal scale; for a *Food* it is in units of 100 grams:
+        planner = self
+        planner.candidates = list(candidates)
+        planner.vectors    = None  # candidates x nutrients matrix for a scale of 1
+        planner.masses     = None  # The grams of each candidate for a scale of 1
+
+    def compile(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Build the candidates x nutrients matrix of *planner* (i.e. *self*) once:
+        planner = self
+        candidates = planner.candidates
+        size = len(candidates)
+        vectors = numpy.empty((size, NUTRIENTS_SIZE), dtype=numpy.float64)
+        masses = numpy.empty(size, dtype=numpy.float64)
+        for candidate_index, candidate in enumerate(candidates):
+            if isinstance(candidate, Recipe):
+                matrix, grams, vector = candidate.compile(client, resolver=resolver)
+                vectors[candidate_index] = vector
+                masses[candidate_index] = candidate.mass
+            else:
+                vectors[candidate_index] = candidate.nutrients
+                masses[candidate_index] = 100.0
+        planner.vectors = vectors
+        planner.masses = masses
+
+    def optimize(self, bounds=None, fractions=None, objective=None, maximum_scale=None):
+        # Verify argument types:
+        assert isinstance(bounds, dict) or bounds is None
+        assert isinstance(fractions, dict) or fractions is None
+        assert isinstance(objective, dict) or objective is None
+        assert isinstance(maximum_scale, float) or isinstance(maximum_scale, int) or \
+          maximum_scale is None
+
+        # Find the candidate scales of *planner* (i.e. *self*) that satisfy:
+        # * *bounds*: nutrient name => (minimum, maximum) totals (e.g. calories and sodium),
+        # * *fractions*: "total_fat", "carbohydrates" or "protein" => (minimum, maximum)
+        #   fractions of the caloric grams (see *Food.caloric_fractions_get*), and
+        # * 0 <= scale <= *maximum_scale* for each candidate,
+        # while minimizing *objective* (nutrient name => weight; by default the total grams).
+        # Every constraint is linear in the scales, so this is a linear program.  Either
+        # bound may be *None*.  The result is (scales, totals) or *None* if it is infeasible:
+        import scipy.optimize
+
+        planner = self
+        vectors = planner.vectors
+        assert vectors is not None, "MealPlanner.compile() has not been called"
+        upper_rows = list()
+        upper_limits = list()
+        def limit(row, minimum, maximum):
+            # Add `minimum <= row @ scales <= maximum` as `A_ub @ scales <= b_ub` rows:
+            if minimum is not None:
+                upper_rows.append(-row)
+                upper_limits.append(-minimum)
+            if maximum is not None:
+                upper_rows.append(row)
+                upper_limits.append(maximum)
+        if bounds is not None:
+            for name, minimum_maximum in bounds.items():
+                minimum, maximum = minimum_maximum
+                limit(vectors[:, NUTRIENT_NAMES.index(name)], minimum, maximum)
+        if fractions is not None:
+            caloric = (vectors[:, NUTRIENT_NAMES.index("total_fat")] +
+              vectors[:, NUTRIENT_NAMES.index("carbohydrates")] +
+              vectors[:, NUTRIENT_NAMES.index("protein")])
+            for name, minimum_maximum in fractions.items():
+                assert name in ("total_fat", "carbohydrates", "protein")
+                minimum, maximum = minimum_maximum
+                column = vectors[:, NUTRIENT_NAMES.index(name)]
+                # `minimum <= column / caloric` is `0 <= column - minimum * caloric`, etc.:
+                if minimum is not None:
+                    limit(column - minimum * caloric, 0.0, None)
+                if maximum is not None:
+                    limit(column - maximum * caloric, None, 0.0)
+        if objective is None:
+            costs = planner.masses
+        else:
+            costs = numpy.zeros(len(planner.candidates), dtype=numpy.float64)
+            for name, weight in objective.items():
+                costs = costs + weight * vectors[:, NUTRIENT_NAMES.index(name)]
+
+        result = scipy.optimize.linprog(costs,
+          A_ub=(numpy.array(upper_rows) if len(upper_rows) > 0 else None),
+          b_ub=(numpy.array(upper_limits) if len(upper_limits) > 0 else None),
+          bounds=(0.0, maximum_scale), method="highs")
+        if not result.success:
+            return None
+        scales = result.x
+        totals = scales @ vectors
+        return scales, totals
+
+    @staticmethod
+    def benchmark(sizes=(100, 1000, 10000), repeats=3, seed=0):
+        # Verify argument types:
+        assert isinstance(sizes, list) or isinstance(sizes, tuple)
+        assert isinstance(repeats, int) and repeats > 0
+
+        # Time *optimize*() on synthetic catalogs of each size in *sizes* and return a list
+        # of (size, best seconds) pairs:
+        random = numpy.random.default_rng(seed)
+        results = list()
+        for size in sizes:
+            # Per 100 gram values loosely shaped like real foods:
+            vectors = random.gamma(1.5, 1.0, (size, NUTRIENTS_SIZE)) * numpy.array(
+              [150.0, 8.0, 2.0, 0.1, 20.0, 200.0, 15.0, 2.0, 5.0, 8.0, 30.0, 200.0])
+            foods = [Food._derived("Food {0}".format(index), 100.0, "g", 100.0, -1,
+              vectors[index], None, -1) for index in range(size)]
+            planner = MealPlanner(foods)
+            planner.compile()
+            best = None
+            for repeat in range(repeats):
+                start = time.perf_counter()
+                planner.optimize(bounds={"calories": (1800.0, 2200.0), "sodium": (None, 2300.0)},
+                  fractions={"total_fat": (0.2, 0.4), "protein": (0.25, None)},
+                  maximum_scale=3.0)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            results.append((size, best))
+        return results
+
+class Recipe:
+    # `__weakref__` lets a *Recipe* be in the *days* and *parents* of other recipes:
+    __slots__ = ("name", "ingredients", "foods", "matrix", "grams", "vector", "mass", "pending",
+      "food", "days", "parents", "__weakref__")
+
+    def __init__(self, name):
+        # Verify argument types:
+        assert isinstance(name, str)
+
+        # Load up *recipe* (i.e. *self*).  The per-ingredient rows and the running total are
+        # kept up to date as ingredients are added, removed or rescaled, so that only new
+        # ingredients ever need to be resolved:
+        recipe = self
+        recipe.name        = name
+        recipe.ingredients = list()
+        recipe.foods       = list()                  # The *Food* of each ingredient (or *None*)
+        recipe.matrix      = numpy.zeros((0, NUTRIENTS_SIZE), dtype=numpy.float64)  # Per 100g
+        recipe.grams       = numpy.zeros(0, dtype=numpy.float64)  # Grams of each ingredient
+        recipe.vector      = numpy.zeros(NUTRIENTS_SIZE, dtype=numpy.float64)  # Unscaled total
+        recipe.mass        = 0.0                     # Unscaled total grams
+        recipe.pending     = 0                       # The number of unresolved *foods*
+        recipe.food        = None                    # The per 100 gram *Food* (or *None*)
+        recipe.days        = weakref.WeakSet()       # The *Day*'s that have *recipe* as a meal
+        recipe.parents     = weakref.WeakSet()       # The *Recipe*'s that use *recipe*
+
+    def __getstate__(self):
+        # *days* and *parents* are rebuilt by the users of *recipe* when they are unpickled:
+        recipe = self
+        return {name: getattr(recipe, name) for name in Recipe.__slots__
+          if name not in ("days", "parents", "__weakref__")}
+
+    def __setstate__(self, state):
+        recipe = self
+        for name, value in state.items():
+            setattr(recipe, name, value)
+        recipe.days = weakref.WeakSet()
+        recipe.parents = weakref.WeakSet()
+        for ingredient in recipe.ingredients:
+            if ingredient.recipe is not None:
+                ingredient.recipe.parents.add(recipe)
+
+    def depends_on(self, other):
+        # Verify argument types:
+        assert isinstance(other, Recipe)
+
+        # Return *True* if *other* is *recipe* (i.e. *self*) or one of its sub-recipes:
+        recipe = self
+        pending = [recipe]
+        visited = set()
+        while len(pending) > 0:
+            current = pending.pop()
+            if current is other:
+                return True
+            if id(current) not in visited:
+                visited.add(id(current))
+                pending.extend(ingredient.recipe
+                  for ingredient in current.ingredients if ingredient.recipe is not None)
+        return False
+
+    def ingredient(self, amount, units, description, food_id=None, upc=None, food=None,
+      recipe=None):
+        # Verify argument types:
+        assert isinstance(amount, float) or isinstance(amount, int)
+        assert isinstance(units, str)
+        assert isinstance(description, str)
+        assert isinstance(food_id, str) or isinstance(food_id, int) or food_id is None
+        assert isinstance(upc, str) or upc is None
+        assert isinstance(food, Food) or food is None
+        assert isinstance(recipe, Recipe) or recipe is None
+        count = 0
+        count += isinstance(food_id, str) or isinstance(food_id, int)
+        count += isinstance(upc, str)
+        count += isinstance(food, Food)
+        count += isinstance(recipe, Recipe)
+        assert count <= 1  # With none of them, the food is found by *description*
+
+        # A sub-*recipe* is measured in grams (or any mass unit) or as a fraction of its
+        # "yield"; it must not (indirectly) contain *parent* (i.e. *self*):
+        parent = self
+        if recipe is not None:
+            assert not recipe.depends_on(parent), \
+              "Recipe '{0}' can not contain itself".format(recipe.name)
+            recipe.parents.add(parent)
+
+        # Create *ingredient*; its arguments have just been checked above:
+        ingredient = Ingredient._validated(float(amount), units.lower(), description,
+          food_id, upc, food, recipe)
+
+        # Append *ingredient* to *recipe* (i.e. *self*) with an empty row for now:
+        recipe = self
+        recipe.ingredients.append(ingredient)
+        recipe.foods.append(None)
+        recipe.matrix = numpy.vstack((recipe.matrix, numpy.zeros((1, NUTRIENTS_SIZE))))
+        recipe.grams = numpy.append(recipe.grams, 0.0)
+        recipe.pending += 1
+
+        # An inline *food* is resolved right away and added to the totals (and can be used by
+        # UPC from then on).  Otherwise, the totals of the *Day*'s that use *recipe* are
+        # unknown until it has been resolved:
+        if food is not None:
+            Food.inline_add(food)
+            recipe._row_resolve(len(recipe.ingredients) - 1, food)
+        else:
+            recipe._changed(None, 0.0)
+
+    def ingredient_remove(self, ingredient_index):
+        # Verify argument types:
+        assert isinstance(ingredient_index, int)
+
+        # Subtract the contribution of the ingredient from the totals of *recipe* (i.e. *self*):
+        recipe = self
+        assert 0 <= ingredient_index < len(recipe.ingredients)
+        grams = float(recipe.grams[ingredient_index])
+        delta_vector = recipe.matrix[ingredient_index] * (-grams / 100.0)
+        if recipe.foods[ingredient_index] is None:
+            recipe.pending -= 1
+        sub_recipe = recipe.ingredients[ingredient_index].recipe
+        del recipe.ingredients[ingredient_index]
+        del recipe.foods[ingredient_index]
+        if sub_recipe is not None and \
+          all(ingredient.recipe is not sub_recipe for ingredient in recipe.ingredients):
+            sub_recipe.parents.discard(recipe)
+        recipe.matrix = numpy.delete(recipe.matrix, ingredient_index, axis=0)
+        recipe.grams = numpy.delete(recipe.grams, ingredient_index)
+        recipe.vector += delta_vector
+        recipe.mass -= grams
+        recipe._changed(delta_vector, -grams)
+
+    def ingredient_amount_set(self, ingredient_index, amount):
+        # Verify argument types:
+        assert isinstance(ingredient_index, int)
+        assert isinstance(amount, float) or isinstance(amount, int)
+
+        # Change the amount of an ingredient of *recipe* (i.e. *self*) and apply the
+        # difference to the totals:
+        recipe = self
+        assert 0 <= ingredient_index < len(recipe.ingredients)
+        ingredient = recipe.ingredients[ingredient_index]
+        ingredient.amount = float(amount)
+        food = recipe.foods[ingredient_index]
+        if food is not None:
+            old_grams = float(recipe.grams[ingredient_index])
+            new_grams = ingredient.grams_get(food)
+            delta_grams = new_grams - old_grams
+            delta_vector = recipe.matrix[ingredient_index] * (delta_grams / 100.0)
+            recipe.grams[ingredient_index] = new_grams
+            recipe.vector += delta_vector
+            recipe.mass += delta_grams
+            recipe._changed(delta_vector, delta_grams)
+
+    def _row_resolve(self, ingredient_index, food):
+        # Fill in the row of a newly resolved ingredient and add it to the totals:
+        recipe = self
+        assert recipe.foods[ingredient_index] is None
+        ingredient = recipe.ingredients[ingredient_index]
+        grams = ingredient.grams_get(food)
+        recipe.foods[ingredient_index] = food
+        recipe.matrix[ingredient_index] = food.nutrients
+        recipe.grams[ingredient_index] = grams
+        delta_vector = food.nutrients * (grams / 100.0)
+        recipe.vector += delta_vector
+        recipe.mass += grams
+        recipe.pending -= 1
+        recipe._changed(delta_vector, grams)
+
+    def _changed(self, delta_vector, delta_mass):
+        # Tell every *Day* that uses *recipe* (i.e. *self*) that its unscaled total changed by
+        # *delta_vector* and *delta_mass* (or, if *delta_vector* is *None*, by an unknown amount):
+        recipe = self
+        recipe.food = None
+        for day in recipe.days:
+            day.recipe_changed(recipe, delta_vector, delta_mass)
+
+        # Any recipe that uses *recipe* as an ingredient has to re-resolve that ingredient:
+        for parent in list(recipe.parents):
+            parent._sub_recipe_changed(recipe)
+
+    def _sub_recipe_changed(self, sub_recipe):
+        # Take the rows of *sub_recipe* back out of *recipe* (i.e. *self*) so that they are
+        # resolved again (with the new per 100 gram values and yield) by *compile*():
+        recipe = self
+        changed = False
+        for ingredient_index, ingredient in enumerate(recipe.ingredients):
+            if ingredient.recipe is sub_recipe and recipe.foods[ingredient_index] is not None:
+                grams = float(recipe.grams[ingredient_index])
+                recipe.vector -= recipe.matrix[ingredient_index] * (grams / 100.0)
+                recipe.mass -= grams
+                recipe.foods[ingredient_index] = None
+                recipe.matrix[ingredient_index] = 0.0
+                recipe.grams[ingredient_index] = 0.0
+                recipe.pending += 1
+                ingredient.grams_per_unit = None
+                changed = True
+        if changed:
+            recipe._changed(None, 0.0)
+
+    def food_get(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Return *recipe* (i.e. *self*) as a per 100 gram *Food*, so that it can be used as an
+        # ingredient.  It is computed once and kept until *recipe* changes, so a sub-recipe
+        # that is shared by many recipes is only evaluated once.  One "yield" is the whole
+        # recipe:
+        recipe = self
+        food = recipe.food
+        if food is None:
+            recipe.compile(client, resolver=resolver)
+            mass = recipe.mass
+            assert mass > 0.0, "Recipe '{0}' has no mass".format(recipe.name)
+            food = Food._derived(recipe.name, 100.0, "g", 100.0, -1,
+              recipe.vector * (100.0 / mass), None, None, {"g": 1.0, "yield": mass})
+            recipe.food = food
+        return food
+
+    def process(self, client=None, scale=1.0, resolver=None, renderer=None, quiet=False):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(scale, float) or isinstance(scale, int)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+        assert isinstance(renderer, BufferedRenderer) or renderer is None
+        assert isinstance(quiet, bool)
+
+        #print("=>Recipe.process(*, *, scale={0})".format(scale))
+
+        # Process *recipe* (i.e. *self*) and hand the report to *renderer*.  Without a
+        # *renderer* the report goes to *sys.stdout* as text, and in *quiet* mode no report
+        # is built at all:
+        recipe = self
+        with Stats.scope("recipe", recipe.name):
+            if quiet and renderer is None:
+                total = recipe.evaluate(client, scale, resolver=resolver)
+            else:
+                report = recipe.report_get(client, scale, resolver=resolver)
+                with Stats.timer("render"):
+                    if renderer is None:
+                        text_renderer = TextRenderer()
+                        text_renderer.recipe(report)
+                        text_renderer.flush()
+                    else:
+                        renderer.recipe(report)
+                total = Food._derived("Total", 0.0, "", report.grams, -1, report.nutrients,
+                  None, -1)
+
+        #print("<=Recipe.process(*, *, scale={0})".format(scale))
+        return total
+
+    def report_get(self, client=None, scale=1.0, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(scale, float) or isinstance(scale, int)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Return a *RecipeReport* for *recipe* (i.e. *self*) scaled by *scale*.  Only
+        # ingredients that have not been resolved yet are looked up; everything else comes
+        # from the compiled rows:
+        recipe = self
+        matrix, grams, vector = recipe.compile(client, resolver=resolver)
+        scaled_grams = grams * scale
+        total_grams = numpy.cumsum(scaled_grams)
+        nutrients = matrix * (scaled_grams / 100.0)[:, None]
+        ingredient_reports = list()
+        for ingredient_index, ingredient in enumerate(recipe.ingredients):
+            # Scaling by *scale* scales the reported amount the same way:
+            ingredient_reports.append(IngredientReport(ingredient_index,
+              ingredient.amount * scale, ingredient.units, ingredient.description,
+              float(scaled_grams[ingredient_index]), float(total_grams[ingredient_index]),
+              nutrients[ingredient_index]))
+        report = RecipeReport(recipe.name, scale, ingredient_reports, scale * recipe.mass,
+          scale * vector)
+        return report
+
+    def compile(self, client=None, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Resolve any ingredients of *recipe* (i.e. *self*) that are still pending.  The result
+        # is an ingredients x nutrients *matrix* (per 100 grams), a *grams* vector and the
+        # unscaled total *vector* (i.e. `grams @ matrix / 100`):
+        recipe = self
+        if recipe.pending > 0:
+            ingredients = recipe.ingredients
+            foods = recipe.foods
+            with Stats.scope("recipe", recipe.name):
+                for ingredient_index, ingredient in enumerate(ingredients):
+                    if foods[ingredient_index] is None:
+                        with Stats.timer("lookup"):
+                            food = ingredient.food_lookup(client, resolver=resolver)
+                        assert isinstance(food, Food)
+                        with Stats.timer("aggregation"):
+                            recipe._row_resolve(ingredient_index, food)
+        return recipe.matrix, recipe.grams, recipe.vector
+
+    def evaluate(self, client=None, scale=1.0, resolver=None):
+        # Verify argument types:
+        assert client is None or food_source_check(client)
+        assert isinstance(scale, float) or isinstance(scale, int)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Compute the total of *recipe* (i.e. *self*) from its compiled form without printing:
+        recipe = self
+        matrix, grams, vector = recipe.compile(client, resolver=resolver)
+        total = Food._derived("Total", 0.0, "", scale * recipe.mass, -1,
+          scale * vector, None, -1)
+        return total
+
+class RecipeBook:
+    # The version of the pickles written into *CACHE_DIRECTORY* by *RecipeBook.load*():
+    CACHE_VERSION = 3
+
+    # The directory (next to each loaded file) that holds its compiled cache:
+    CACHE_DIRECTORY = "__foodcache__"
+
+    def __init__(self):
+        # Load up *book* (i.e. *self*).  Each table maps a name to its definition in file order:
+        book = self
+        book.foods   = collections.OrderedDict()   # *Food* description => *Food*
+        book.recipes = collections.OrderedDict()   # *Recipe* name => *Recipe*
+        book.days    = collections.OrderedDict()   # *Day* name => *Day*
+
+    @staticmethod
+    def definitions_read(path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        # Generate the (kind, definition) pairs of *path*, where kind is "food", "recipe" or
+        # "day".  A ".json" or ".toml" file has "foods", "recipes" and "days" lists, while a
+        # ".jsonl" file has one `{"<kind>": definition}` object per line and is read a line
+        # at a time:
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".jsonl":
+            with open(path) as definitions_file:
+                for line in definitions_file:
+                    line = line.strip()
+                    if line != "":
+                        entry = json.loads(line)
+                        assert isinstance(entry, dict) and len(entry) == 1, \
+                          "Bad line in '{0}': {1}".format(path, line)
+                        kind, definition = next(iter(entry.items()))
+                        yield kind, definition
+            return
+        if extension == ".toml":
+            import tomllib
+            with open(path, "rb") as definitions_file:
+                document = tomllib.load(definitions_file)
+        else:
+            assert extension == ".json", "Unknown recipe file type '{0}'".format(path)
+            with open(path) as definitions_file:
+                document = json.load(definitions_file)
+        for kind in ("food", "recipe", "day"):
+            for definition in document.get(kind + "s", ()):
+                yield kind, definition
+
+    def definition_add(self, kind, definition):
+        # Verify argument types:
+        assert isinstance(kind, str)
+        assert isinstance(definition, dict)
+
+        # Create the *Food*, *Recipe* or *Day* of *definition* and add it to *book* (i.e.
+        # *self*).  Ingredients and meals refer to foods and recipes defined before them:
+        book = self
+        if kind == "food":
+            food = Food(**definition)
+            Food.inline_add(food)
+            book.foods[food.description] = food
+        elif kind == "recipe":
+            recipe = Recipe(definition["name"])
+            for ingredient in definition["ingredients"]:
+                food = ingredient.get("food")
+                sub_recipe = ingredient.get("recipe")
+                assert food is None or food in book.foods, \
+                  "Recipe '{0}' uses undefined food '{1}'".format(recipe.name, food)
+                assert sub_recipe is None or sub_recipe in book.recipes, \
+                  "Recipe '{0}' uses undefined recipe '{1}'".format(recipe.name, sub_recipe)
+                recipe.ingredient(ingredient["amount"], ingredient["units"],
+                  ingredient.get("description", food or sub_recipe or ""),
+                  food_id=ingredient.get("food_id"), upc=ingredient.get("upc"),
+                  food=None if food is None else book.foods[food],
+                  recipe=None if sub_recipe is None else book.recipes[sub_recipe])
+            book.recipes[recipe.name] = recipe
+        elif kind == "day":
+            day = Day(definition["name"])
+            for meal in definition["meals"]:
+                assert meal["recipe"] in book.recipes, \
+                  "Day '{0}' uses undefined recipe '{1}'".format(day.name, meal["recipe"])
+                day.meal(book.recipes[meal["recipe"]], float(meal.get("scale", 1.0)))
+            book.days[day.name] = day
+        else:
+            assert False, "Unknown definition kind '{0}'".format(kind)
+
+    @staticmethod
+    def load(path, client=None, resolver=None):
+        # Verify argument types:
+        assert isinstance(path, str)
+        assert client is None or food_source_check(client)
+        assert isinstance(resolver, FoodResolver) or resolver is None
+
+        # Return the *RecipeBook* of *path*.  Like a `.pyc` file, the parsed book is pickled
+        # into *CACHE_DIRECTORY* along with the hash of the contents of *path*, so an unchanged
+        # file is just unpickled.  Only the parsed book is cached: its foods depend on the
+        # catalog and the store as well as on *path*, so when *client* is given every recipe
+        # is compiled (through *resolver*) after it has been loaded.  The foods of the days
+        # are first fetched concurrently (see *FoodResolver.prefetch*):
+        with open(path, "rb") as path_file:
+            digest = hashlib.sha256(path_file.read())
+        digest.update(str(RecipeBook.CACHE_VERSION).encode())
+        digest = digest.hexdigest()
+        directory, base_name = os.path.split(os.path.abspath(path))
+        cache_directory = os.path.join(directory, RecipeBook.CACHE_DIRECTORY)
+        cache_path = os.path.join(cache_directory, base_name + ".pickle")
+
+        book = None
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cache_digest, book = _FoodUnpickler(cache_file).load()
+            if cache_digest != digest:
+                book = None
+        except (OSError, EOFError, ValueError, AttributeError, pickle.UnpicklingError):
+            # A missing, truncated or out of date cache is simply rebuilt:
+            book = None
+        if book is None:
+            book = RecipeBook()
+            for kind, definition in RecipeBook.definitions_read(path):
+                book.definition_add(kind, definition)
+
+            # Write the cache before anything is resolved:
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+                scratch_path = "{0}.{1}".format(cache_path, os.getpid())
+                with open(scratch_path, "wb") as cache_file:
+                    pickle.dump((digest, book), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(scratch_path, cache_path)
+            except OSError:
+                pass  # A read-only directory just means no cache
+        else:
+            # The foods of a cached book are defined again, so they can be found by UPC:
+            for food in book.foods.values():
+                Food.inline_add(food)
+        if resolver is not None and len(book.days) > 0:
+            resolver.prefetch(list(book.days.values()))
+        if client is not None:
+            for recipe in book.recipes.values():
+                recipe.compile(client, resolver=resolver)
+        return book
+
+    @staticmethod
+    def paths_get(paths):
+        # Generate the file paths of *paths* (any iterable of *str*), where a directory yields
+        # each of its ".json", ".jsonl" and ".toml" files in sorted order:
+        for path in paths:
+            assert isinstance(path, str)
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if os.path.splitext(name)[1].lower() in (".json", ".jsonl", ".toml"):
+                        yield os.path.join(path, name)
+            else:
+                yield path
+
+    @staticmethod
+    def stream(paths, client=None, resolver=None):
+        # Verify argument types:
+        assert isinstance(paths, list) or isinstance(paths, tuple)
+
+        # Generate the (path, *RecipeBook*) of each of *paths* in turn, so that only one file
+        # worth of definitions is in memory at a time:
+        for file_path in RecipeBook.paths_get(paths):
+            yield file_path, RecipeBook.load(file_path, client=client, resolver=resolver)
+
+class Stats:
+    # The *Stats* that the hot paths record into, or *None* (the default) when the
+    # instrumentation is off, in which case each timer costs one attribute test:
+    active = None
+
+    # The most trace events kept for `food.py report --trace FILE` (and `batch`):
+    TRACE_LIMIT = 1 << 20
+
+    def __init__(self, trace_limit=0):
+        # Verify argument types:
+        assert isinstance(trace_limit, int) and trace_limit >= 0
+
+        # Load up *stats* (i.e. *self*).  Timers are inclusive, so a "lookup" includes the
+        # "cache_read" and "fetch" inside of it:
+        stats = self
+        stats.lock        = threading.Lock()
+        stats.timers      = dict()              # name => [count, seconds, maximum seconds]
+        stats.counters    = dict()              # name => count
+        stats.scopes      = dict()              # "day:X/recipe:Y" => {name => [count, ...]}
+        stats.local       = threading.local()   # *local.scope* is the scope of each thread
+        stats.trace_limit = trace_limit         # The most trace events kept
+        stats.events      = list()              # Chrome trace events (up to *trace_limit*)
+        stats.start       = time.perf_counter()
+
+    def __getstate__(self):
+        # Pickle (e.g. to send it back from a `batch` worker) without the lock and locals:
+        stats = self
+        with stats.lock:
+            state = {"timers": stats.timers, "counters": stats.counters,
+              "scopes": stats.scopes, "trace_limit": stats.trace_limit,
+              "events": stats.events, "start": stats.start}
+        return state
+
+    def __setstate__(self, state):
+        stats = self
+        stats.__dict__.update(state)
+        stats.lock = threading.Lock()
+        stats.local = threading.local()
+
+    @staticmethod
+    def enable(trace_limit=0):
+        # Start recording into a new *Stats* and return it:
+        stats = Stats(trace_limit)
+        Stats.active = stats
+        return stats
+
+    @staticmethod
+    def disable():
+        # Stop recording and return the *Stats* that was being recorded into (or *None*):
+        stats = Stats.active
+        Stats.active = None
+        return stats
+
+    @staticmethod
+    def timer(name):
+        # Return a context manager that times its body as *name* (a no-op when disabled):
+        stats = Stats.active
+        if stats is None:
+            return _STATS_NULL_TIMER
+        return _StatsTimer(stats, name, None)
+
+    @staticmethod
+    def scope(kind, name):
+        # Return a context manager under which every timer is also broken down by the
+        # *kind* (e.g. "day" or "recipe") *name* scope:
+        stats = Stats.active
+        if stats is None:
+            return _STATS_NULL_TIMER
+        scope = "{0}:{1}".format(kind, name)
+        parent = getattr(stats.local, "scope", "")
+        if parent == scope or parent.endswith("/" + scope):
+            return _STATS_NULL_TIMER  # Already in *scope* (e.g. *Recipe.compile* in *process*)
+        return _StatsTimer(stats, kind, scope)
+
+    @staticmethod
+    def count(name, amount=1):
+        # Add *amount* to the *name* counter (a no-op when disabled):
+        stats = Stats.active
+        if stats is not None:
+            with stats.lock:
+                stats.counters[name] = stats.counters.get(name, 0) + amount
+
+    def record(self, name, scope, started, seconds):
+        # Add a *seconds* long *name* timing that *started* (a *time.perf_counter*() value)
+        # within *scope* to *stats* (i.e. *self*):
+        stats = self
+        with stats.lock:
+            timings = [stats.timers]
+            if scope != "":
+                timings.append(stats.scopes.setdefault(scope, dict()))
+            for timing in timings:
+                entry = timing.get(name)
+                if entry is None:
+                    timing[name] = [1, seconds, seconds]
+                else:
+                    entry[0] += 1
+                    entry[1] += seconds
+                    if seconds > entry[2]:
+                        entry[2] = seconds
+            if len(stats.events) < stats.trace_limit:
+                stats.events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                  "tid": threading.get_ident(), "ts": (started - stats.start) * 1e6,
+                  "dur": seconds * 1e6, "args": {"scope": scope}})
+
+    def merge(self, other):
+        # Verify argument types:
+        assert isinstance(other, Stats)
+
+        # Add the timers, counters and trace events of *other* (e.g. from a `batch` worker) to
+        # *stats* (i.e. *self*).  *time.perf_counter*() is the same clock in every process, so
+        # the events of *other* are just moved onto the time line of *stats*:
+        stats = self
+        other = other.__getstate__()
+        with stats.lock:
+            timings_pairs = [(stats.timers, other["timers"])]
+            for scope, timings in other["scopes"].items():
+                timings_pairs.append((stats.scopes.setdefault(scope, dict()), timings))
+            for timings, other_timings in timings_pairs:
+                for name, (count, seconds, maximum) in other_timings.items():
+                    entry = timings.get(name)
+                    if entry is None:
+                        timings[name] = [count, seconds, maximum]
+                    else:
+                        entry[0] += count
+                        entry[1] += seconds
+                        if maximum > entry[2]:
+                            entry[2] = maximum
+            counters = stats.counters
+            for name, count in other["counters"].items():
+                counters[name] = counters.get(name, 0) + count
+            shift = (other["start"] - stats.start) * 1e6
+            for event in other["events"][:max(stats.trace_limit - len(stats.events), 0)]:
+                event = dict(event)
+                event["ts"] += shift
+                stats.events.append(event)
+
+    def dict_get(self):
+        # Return the timers, counters and per-scope timers of *stats* (i.e. *self*) as plain
+        # *dict*'s that can be logged as JSON:
+        stats = self
+        def timings_get(timings):
+            return {name: {"count": count, "seconds": seconds, "maximum_seconds": maximum}
+              for name, (count, seconds, maximum) in timings.items()}
+        with stats.lock:
+            result = {
+              "timers":   timings_get(stats.timers),
+              "counters": dict(stats.counters),
+              "scopes":   {scope: timings_get(timings)
+                for scope, timings in stats.scopes.items()},
+            }
+        return result
+
+    def summary_string(self):
+        # Return a one line summary of the timers and counters of *stats* (i.e. *self*):
+        stats = self
+        with stats.lock:
+            timers = " ".join("{0}={1}x{2:.1f}ms".format(name, count, seconds * 1000.0)
+              for name, (count, seconds, maximum) in sorted(stats.timers.items()))
+            counters = " ".join("{0}={1}".format(name, count)
+              for name, count in sorted(stats.counters.items()))
+        return "{0} {1}".format(timers, counters).strip()
+
+    def json_write(self, path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        # Write the timers, counters and per-scope timers of *stats* (i.e. *self*) to *path*
+        # as JSON (see *dict_get*):
+        stats = self
+        with open(path, "w") as json_file:
+            json.dump(stats.dict_get(), json_file, indent=2, sort_keys=True)
+
+    def trace_write(self, path):
+        # Verify argument types:
+        assert isinstance(path, str)
+
+        # Write the events of *stats* (i.e. *self*) in the Chrome trace format, which can be
+        # viewed with `chrome://tracing` or https://ui.perfetto.dev:
+        stats = self
+        with stats.lock:
+            events = list(stats.events)
+        trace = {"traceEvents": events, "otherData": stats.dict_get()}
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+
+class _StatsTimer:
+    def __init__(self, stats, name, scope):
+        # A context manager that records its duration as *name* into *stats*; with a *scope*
+        # it also makes *scope* the current scope of its thread while it runs:
+        timer = self
+        timer.stats   = stats
+        timer.name    = name
+        timer.scope   = scope
+        timer.parent  = None
+        timer.started = 0.0
+
+    def __enter__(self):
+        timer = self
+        stats = timer.stats
+        if stats is not None:
+            local = stats.local
+            parent = getattr(local, "scope", "")
+            timer.parent = parent
+            if timer.scope is not None:
+                local.scope = timer.scope if parent == "" else parent + "/" + timer.scope
+            timer.started = time.perf_counter()
+        return timer
+
+    def __exit__(self, exception_type, exception, traceback):
+        timer = self
+        stats = timer.stats
+        if stats is not None:
+            seconds = time.perf_counter() - timer.started
+            local = stats.local
+            stats.record(timer.name, local.scope if timer.scope is not None else timer.parent,
+              timer.started, seconds)
+            local.scope = timer.parent
+        return False
+
+# The timer returned while *Stats* are disabled:
+_STATS_NULL_TIMER = _StatsTimer(None, "", None)
+
+class TextRenderer(BufferedRenderer):
+    def recipe(self, report):
+        # Verify argument types:
+        assert isinstance(report, RecipeReport)
+
+        renderer = self
+        scale = report.scale
+        lines = ["Recipe: {0}{1}".format(report.name,
+          ("" if scale == 1.0 else " x {0:.2}".format(scale)) )]
+        for ingredient in report.ingredients:
+            lines.append("[{0:>2}] {1:>5}g{2:>5}g{3:>5}cal  {4:.2f}{5} {6})".
+              format(ingredient.index, int(ingredient.grams), int(ingredient.total_grams),
+              int(ingredient.nutrients[0]), ingredient.amount, ingredient.units,
+              ingredient.description))
+        total = Food._derived("Total", 0.0, "", report.grams, -1, report.nutrients, None, -1)
+        lines.append(total.summary_string())
+        lines.append("")
+        lines.append("")
+        renderer.write("\n".join(lines))
+
+    def food(self, food, heading=None):
+        # Verify argument types:
+        assert isinstance(food, Food)
+        assert isinstance(heading, str) or heading is None
+
+        renderer = self
+        renderer.write(food.to_string(heading) + "\n")
+
+    def error(self, message, heading=None):
+        # Verify argument types:
+        assert isinstance(message, str)
+        assert isinstance(heading, str) or heading is None
+
+        renderer = self
+        renderer.write("{0}Error: {1}\n\n".format(
+          "" if heading is None else heading + ": ", message))
+
+# The renderers that `food.py batch --format FORMAT` can write:
+BATCH_RENDERERS = {
+  "csv":   CsvRenderer,
+  "jsonl": JsonLinesRenderer,
+  "text":  TextRenderer,
+}
+
+# The per-process state of a `batch` worker, set up by *_batch_initialize*():
+_batch_state = None
+
+def _batch_initialize(api_key, store_path, output_format, rate, shared_path, barrier,
+  trace_limit):
+    # Open the shared caches read only in a `batch` worker process.  The catalogs are memory
+    # mapped, so every worker shares the same pages.  The imported catalog is searched first
+    # (as always) and then *shared_path* (if not *None*), which has the fresh foods that were
+    # in the store when the batch started (see *FoodCatalog.publish*); the stale ones are
+    # still found in the store, which revalidates them.  Foods fetched from the USDA are sent
+    # back to the parent, which is the only writer of the store.  Each worker gets its share
+    # of the USDA request *rate*.  Without an *api_key* there is no USDA at all (offline).
+    # *barrier* is shared by every worker for *_batch_finish*().  Unless *trace_limit* is
+    # *None*, the worker records its own *Stats* (keeping up to *trace_limit* events):
+    global _batch_state
+    Stats.disable()  # Do not add to a copy of the *Stats* of the parent
+    if trace_limit is not None:
+        Stats.enable(trace_limit)
+    client = None if api_key is None else usda_client_create(api_key)
+    store = FoodStore(store_path, read_only=True)
+    catalog = FoodCatalog.default_get()
+    if shared_path is not None:
+        shared_catalog = FoodCatalog(shared_path)
+        if catalog is None:
+            catalog = shared_catalog
+        else:
+            catalog.fallback = shared_catalog
+    resolver = FoodResolver(client, store=store, catalog=catalog,
+      scheduler=None if client is None else FetchScheduler(client, rate=rate))
+    _batch_state = (client, resolver, output_format, barrier)
+
+def _batch_file_process(path):
+    # Process every *Day* in the recipe file at *path* inside a `batch` worker and return the
+    # rendered text, the number of days, any foods that need to be written to the store and
+    # an error message that starts with *path* (or *None*).  A file that fails (a parse
+    # error, an unknown UPC, a failed fetch, ...) is rendered as a single error record
+    # instead of its days, so that one bad file does not stop the whole batch:
+    client, resolver, output_format, barrier = _batch_state
+    def renderer_create():
+        output = io.StringIO()
+        if output_format == "csv":
+            return output, CsvRenderer(output, header=False)
+        return output, BATCH_RENDERERS[output_format](output)
+
+    output, renderer = renderer_create()
+    error = None
+    try:
+        book = RecipeBook.load(path, client=client, resolver=resolver)
+        for day in book.days.values():
+            day_total = day.process(client, resolver=resolver, quiet=True)
+            renderer.food(day_total, heading="{0}:{1}".format(path, day.name))
+        days = len(book.days)
+    except Exception as exception:
+        error = "{0}: {1}".format(type(exception).__name__, exception)
+        output, renderer = renderer_create()
+        renderer.error(error, heading=path)
+        error = "{0}: {1}".format(path, error)
+        days = 0
+    renderer.flush()
+    return output.getvalue(), days, _batch_unwritten_get(resolver.store), error
+
+def _batch_finish(index):
+    # Run once in every `batch` worker after the last file.  The *barrier* holds each worker
+    # until all of them have one of these calls.  The revalidations that have not started
+    # are dropped (the foods are still stale in the next run) and the foods fetched by the
+    # finished ones are returned to the parent, rather than being lost when the worker exits.
+    # So are the *Stats* of the worker (or *None*), for the parent to merge:
+    client, resolver, output_format, barrier = _batch_state
+    try:
+        barrier.wait(FoodStore.REVALIDATE_WAIT)
+    except threading.BrokenBarrierError:
+        pass
+    store = resolver.store
+    store.revalidations_cancel()
+    stats = Stats.active
+    if stats is not None:
+        Stats.enable(stats.trace_limit)  # Each *Stats* is returned only once
+    return _batch_unwritten_get(store), stats
+
+def _batch_unwritten_get(store):
+    # Return (and forget) the foods that were put into the read only *store* of a worker:
+    with store.lock:
+        unwritten = store.unwritten
+        store.unwritten = dict()
+    return unwritten
+
+def batch(paths, stream=None, output_format="jsonl", workers=None, chunksize=16,
+  api_key="DEMO_KEY", rate=1000.0 / 3600.0, shared=True):
+    # Verify argument types:
+    assert stream is None or hasattr(stream, "write")
+    assert output_format in BATCH_RENDERERS
+    assert isinstance(workers, int) or workers is None
+    assert isinstance(chunksize, int) and chunksize > 0
+    assert isinstance(api_key, str) or api_key is None
+
+    # Process every *Day* in the recipe files of *paths* (an iterable that is consumed
+    # lazily) across a pool of *workers* processes, *chunksize* files at a time.  The day
+    # totals are written to *stream* in the order of *paths*; a file that fails is written as
+    # an error record (and reported on *sys.stderr*) and the batch goes on.  If *shared*, the
+    # fresh stored foods are unpickled once here and published as a shared catalog, rather
+    # than by every worker into its own memory.  When *Stats* are enabled, the workers record
+    # them too and they are merged into *Stats.active*.  Return the number of days:
+    stream = sys.stdout if stream is None else stream
+    if output_format == "csv":
+        CsvRenderer(stream).flush()
+    store = FoodStore.default_get()
+    store.get_many([])  # Create the store before any worker opens it read only
+    shared_path = None
+    if shared:
+        foods = store.foods_get(fresh=True)
+        if len(foods) > 0:
+            shared_path = FoodCatalog.publish(foods)
+        del foods
+    day_count = 0
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    try:
+        barrier = multiprocessing.Barrier(workers)
+        stats = Stats.active
+        pool = multiprocessing.Pool(workers, initializer=_batch_initialize,
+          initargs=(api_key, store.path, output_format, rate / workers, shared_path, barrier,
+          None if stats is None else stats.trace_limit))
+    except:
+        if shared_path is not None:
+            shutil.rmtree(os.path.dirname(shared_path))
+        raise
+    try:
+        for text, days, unwritten, error in pool.imap(_batch_file_process,
+          RecipeBook.paths_get(paths), chunksize):
+            stream.write(text)
+            day_count += days
+            if error is not None:
+                sys.stderr.write("batch: {0}\n".format(error))
+            for source, foods in unwritten.items():
+                store.put_many(foods, source=source)
+        for unwritten, worker_stats in pool.map(_batch_finish, range(workers), 1):
+            for source, foods in unwritten.items():
+                store.put_many(foods, source=source)
+            if stats is not None and worker_stats is not None:
+                stats.merge(worker_stats)
+    finally:
+        pool.close()
+        pool.join()
+        if shared_path is not None:
+            shutil.rmtree(os.path.dirname(shared_path))
+    stream.flush()
+    return day_count
+
+def _options_parse(arguments, options):
+    # Fill in the values of the *options* (a *dict* of option => default) that are given in
+    # *arguments* and return whether `--offline` was given and the remaining arguments:
+    offline = False
+    remaining = list()
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument == "--offline":
+            offline = True
+            index += 1
+        elif argument in options and index + 1 < len(arguments):
+            options[argument] = arguments[index + 1]
+            index += 2
+        else:
+            remaining.append(argument)
+            index += 1
+    return offline, remaining
+
+def _stats_start(stats_path, trace_path):
+    # Turn the *Stats* on for `--stats FILE` and/or `--trace FILE`; trace events are only
+    # kept for the latter:
+    if stats_path is not None or trace_path is not None:
+        Stats.enable(0 if trace_path is None else Stats.TRACE_LIMIT)
+
+def _stats_finish(stats_path, trace_path):
+    # Turn the *Stats* off and write them to *stats_path* and/or *trace_path* (if not *None*):
+    stats = Stats.disable()
+    if stats is not None:
+        if stats_path is not None:
+            stats.json_write(stats_path)
+        if trace_path is not None:
+            stats.trace_write(trace_path)
+
+def main():
+    # `food.py import SOURCE CATALOG` builds an offline *FoodCatalog* from a USDA download:
+    arguments = sys.argv[1:]
+    if len(arguments) == 3 and arguments[0] == "import":
+        size = FoodCatalog.usda_import(arguments[1], arguments[2])
+        print("Imported {0} foods into '{1}'".format(size, arguments[2]))
+        return 0
+
+    # `food.py plan-benchmark [SIZE ...]` reports *MealPlanner* solve times by catalog size:
+    if len(arguments) >= 1 and arguments[0] == "plan-benchmark":
+        sizes = [int(size) for size in arguments[1:]] or [100, 1000, 10000]
+        for size, seconds in MealPlanner.benchmark(sizes):
+            print("{0:>8} foods: {1:8.2f}ms".format(size, seconds * 1000.0))
+        return 0
+
+    # `food.py index [CATALOG]` builds the *FoodSearchIndex* from a catalog and the food store:
+    if len(arguments) in (1, 2) and arguments[0] == "index":
+        catalog_path = arguments[1] if len(arguments) == 2 else FOOD_CATALOG_PATH
+        catalog = (FoodCatalog(catalog_path)
+          if os.path.isfile(os.path.join(catalog_path, "catalog.json")) else None)
+        search_index = FoodSearchIndex.build(catalog=catalog, store=FoodStore.default_get())
+        search_index.save(FOOD_SEARCH_INDEX_PATH)
+        print("Indexed {0} foods into '{1}'".format(
+          len(search_index.food_ids), FOOD_SEARCH_INDEX_PATH))
+        return 0
+
+    # `food.py report [--offline] [--stats FILE] [--trace FILE] PATH ...` processes every
+    # *Day* defined in recipe files (or directories).  With `--offline` only inline, catalog
+    # and stored foods are used.  `--stats` writes the *Stats* timers and counters as JSON and
+    # `--trace` writes a Chrome trace of the run:
+    if len(arguments) >= 2 and arguments[0] == "report":
+        options = {"--stats": None, "--trace": None}
+        offline, paths = _options_parse(arguments[1:], options)
+        client = None
+        scheduler = None
+        if not offline:
+            client = usda_client_create("mQBfPvhuiXk7gZ9gYA8I0gGD3kiKEfQvuDxz04Z8")
+            scheduler = FetchScheduler(client)
+        resolver = FoodResolver(client, store=FoodStore.default_get(),
+          catalog=FoodCatalog.default_get(), scheduler=scheduler)
+        _stats_start(options["--stats"], options["--trace"])
+        try:
+            for path, book in RecipeBook.stream(paths, client=client, resolver=resolver):
+                for day in book.days.values():
+                    day_total = day.process(client, resolver=resolver)
+                    print(day_total.to_string("Day: {0} ({1})".format(day.name, path)))
+        finally:
+            _stats_finish(options["--stats"], options["--trace"])
+        return 0
+
+    # `food.py batch [-j WORKERS] [--format csv|jsonl|text] [--chunksize N] [--offline]
+    # [--stats FILE] [--trace FILE] PATH ...` processes the days in many recipe files in
+    # parallel; a PATH of "-" reads paths from *sys.stdin*.  `--stats` and `--trace` are as
+    # for `report`, with the *Stats* of every worker merged in:
+    if len(arguments) >= 2 and arguments[0] == "batch":
+        options = {"-j": None, "--format": "jsonl", "--chunksize": "16", "--stats": None,
+          "--trace": None}
+        offline, paths = _options_parse(arguments[1:], options)
+        if paths == ["-"]:
+            paths = (line.strip() for line in sys.stdin if line.strip() != "")
+        _stats_start(options["--stats"], options["--trace"])
+        try:
+            batch(paths, output_format=options["--format"],
+              workers=None if options["-j"] is None else int(options["-j"]),
+              chunksize=int(options["--chunksize"]),
+              api_key=None if offline else "mQBfPvhuiXk7gZ9gYA8I0gGD3kiKEfQvuDxz04Z8")
+        finally:
+            _stats_finish(options["--stats"], options["--trace"])
+        return 0
+
+    # `food.py refresh [--max-age DAYS] [--budget REQUESTS]` re-fetches the stale USDA foods in
+    # the food store, oldest first, without going over a USDA request budget:
+    if len(arguments) >= 1 and arguments[0] == "refresh":
+        options = {"--max-age": None, "--budget": "200"}
+        for index in range(1, len(arguments) - 1, 2):
+            assert arguments[index] in options, "Unknown option '{0}'".format(arguments[index])
+            options[arguments[index]] = arguments[index + 1]
+        client = usda_client_create("mQBfPvhuiXk7gZ9gYA8I0gGD3kiKEfQvuDxz04Z8")
+        max_age = options["--max-age"]
+        counts = FoodStore.default_get().refresh(FetchScheduler(client).fetch,
+          max_age=None if max_age is None else float(max_age) * 24.0 * 3600.0,
+          budget=int(options["--budget"]))
+        print("Refreshed {0} foods ({1} failed, {2} still stale)".format(
+          counts["refreshed"], counts["failed"], counts["stale"]))
+        return 0
 
-def main():
     # Create *chili_recipe*:
     ground_beef = Food("Lean Ground Beef (7% Fat) Crumbles",
       -1, "", 100, 209, 9.48, .241, 3.897, 0, 86, 0, 0, 0, 28.88, calcium=12, potassium=449)
@@ -665,7 +4187,7 @@ def main():
     peppermint_bar_recipe.ingredient(45,
       "g", "Peppermint Cocoa Crunch Bar", food=peppermint_cocoa_crunch_bar)
 
-    client = UsdaClient("mQBfPvhuiXk7gZ9gYA8I0gGD3kiKEfQvuDxz04Z8")
+    client = usda_client_create("mQBfPvhuiXk7gZ9gYA8I0gGD3kiKEfQvuDxz04Z8")
 
     day = Day("Today")
     day.meal(omlette_recipe)
@@ -688,7 +4210,11 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    main()
+    # Run `main` from the `food` module rather than from `__main__`, so that there is only one
+    # *Food* (etc.) class and the pickles written by the command line and by programs that
+    # `import food` can be read by both:
+    import food
+    sys.exit(food.main())
 
 
 646049003406
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+#<-------------------------------------------- 100 characters ------------------------------------>|
+
+# Offline benchmarks for the hot paths of `food.py`.  Everything runs against a synthetic
+# *FoodCatalog*, a scratch *FoodStore* and *FakeUsdaClient*, so no network access is needed.
+#
+#     ./food_benchmark.py [--size N] [--latency SECONDS] [--output FILE] [--compare FILE] [NAME...]
+#
+# The results are written as JSON so that two runs can be compared with `--compare`.
+
+import collections
+import food
+import http.server
+import io
+import json
+import numpy
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import usda
+from food import Day, FetchScheduler, Food, FoodCatalog, FoodResolver, FoodStore, Ingredient, \
+  Recipe
+from usda.client import UsdaClient
+
+# The version of the JSON written by *results_write*():
+RESULTS_VERSION = 1
+
+# The USDA nutrient names and units that *Food.usda_fetch* reads, in *NUTRIENT_NAMES* order:
+USDA_NUTRIENTS = (
+  ("Energy",                       "kcal"),
+  ("Total lipid (fat)",            "g"),
+  ("Fatty acids, total saturated", "g"),
+  ("Fatty acids, total trans",     "g"),
+  ("Cholesterol",                  "mg"),
+  ("Sodium, Na",                   "mg"),
+  ("Carbohydrate, by difference",  "g"),
+  ("Fiber, total dietary",         "g"),
+  ("Sugars, total",                "g"),
+  ("Protein",                      "g"),
+  ("Calcium, Ca",                  "mg"),
+  ("Potassium, K",                 "mg"),
+)
+
+# Typical per 100 gram values used to shape the synthetic nutrients:
+NUTRIENT_SCALES = numpy.array(
+  [150.0, 8.0, 2.0, 0.1, 20.0, 200.0, 15.0, 2.0, 5.0, 8.0, 30.0, 200.0])
+
+def synthetic_nutrients_get(seed, food_id):
+    # Return made up per 100 gram nutrients that only depend on *seed* and *food_id*:
+    random = numpy.random.default_rng((seed, int(food_id)))
+    return random.gamma(1.5, 1.0, food.NUTRIENTS_SIZE) * NUTRIENT_SCALES
+
+class Benchmarks:
+    def __init__(self, size=1000, latency=0.001, seed=0):
+        # Verify argument types:
+        assert isinstance(size, int) and size > 0
+        assert isinstance(latency, float) or isinstance(latency, int)
+
+        # Build the synthetic world shared by every benchmark in a scratch directory:
+        # *size* catalog foods (ids 1..size), *size* store only foods (ids after those) and
+        # recipes/days that use both:
+        benchmarks = self
+        random = numpy.random.default_rng(seed)
+        directory = tempfile.mkdtemp(prefix="food_benchmark.")
+        catalog_path = os.path.join(directory, "catalog")
+        nutrients = random.gamma(1.5, 1.0, (size, food.NUTRIENTS_SIZE)) * NUTRIENT_SCALES
+        FoodCatalog.write(catalog_path, [(food_id, food_id - 1) for food_id in range(1, size + 1)],
+          [], ["Catalog Food {0}".format(food_id) for food_id in range(1, size + 1)], nutrients,
+          [[(1.0, "cup", 240.0), (1.0, "slice", 30.0)]] * size)
+        client = FakeUsdaClient(latency=latency, seed=seed)
+        catalog = FoodCatalog(catalog_path)
+        store = FoodStore(os.path.join(directory, "store.sqlite3"))
+        store.put_many([Food.usda_fetch(FakeUsdaClient(seed=seed), food_id)
+          for food_id in range(size + 1, 2 * size + 1)])
+        resolver = FoodResolver(client, store=store, catalog=catalog)
+
+        # Ten recipes of twelve ingredients each, mixing catalog, store and inline foods:
+        inline_foods = [Food("Inline Food {0}".format(index), 1, "cup", 240.0,
+          *[float(value) for value in row[:10]], calcium=float(row[10]),
+          potassium=float(row[11])) for index, row in enumerate(nutrients[:12])]
+        recipes = list()
+        for recipe_index in range(10):
+            recipe = Recipe("Recipe {0}".format(recipe_index))
+            for ingredient_index in range(12):
+                amount = float(random.integers(1, 4))
+                if ingredient_index % 3 == 0:
+                    recipe.ingredient(amount, "cup", "inline",
+                      food=inline_foods[ingredient_index])
+                else:
+                    food_id = int(random.integers(1, 2 * size + 1))
+                    recipe.ingredient(amount, "slice", "food {0}".format(food_id),
+                      food_id=food_id)
+            recipes.append(recipe)
+        day = Day("Benchmark Day")
+        for recipe_index, recipe in enumerate(recipes):
+            day.meal(recipe, 0.5 + recipe_index / 10.0)
+
+        # Load up *benchmarks*:
+        benchmarks.directory    = directory
+        benchmarks.size         = size
+        benchmarks.latency      = latency
+        benchmarks.random       = random
+        benchmarks.client       = client
+        benchmarks.catalog      = catalog
+        benchmarks.store        = store
+        benchmarks.resolver     = resolver
+        benchmarks.inline_foods = inline_foods
+        benchmarks.recipes      = recipes
+        benchmarks.day          = day
+        benchmarks.miss_id      = 2 * size + 1  # The next food id that has never been seen
+        benchmarks.server       = None          # The *StandInUsdaServer* (once started)
+
+    def close(self):
+        benchmarks = self
+        if benchmarks.server is not None:
+            benchmarks.server.close()
+        benchmarks.store.close()
+        shutil.rmtree(benchmarks.directory, ignore_errors=True)
+
+    # Each `*_operation` method returns a function that performs one operation:
+
+    def food_init_operation(self):
+        values = [float(value) for value in NUTRIENT_SCALES]
+        def operation():
+            Food("Benchmark Food", 1, "cup", 240.0, *values[:10], calcium=values[10],
+              potassium=values[11])
+        return operation
+
+    def food_add_operation(self):
+        benchmarks = self
+        food1 = benchmarks.inline_foods[0] * 100.0
+        food2 = benchmarks.inline_foods[1] * 50.0
+        def operation():
+            food1 + food2
+        return operation
+
+    def food_mul_operation(self):
+        benchmarks = self
+        inline_food = benchmarks.inline_foods[0]
+        def operation():
+            inline_food * 150.0
+        return operation
+
+    def recipe_process_operation(self):
+        # Build a recipe from scratch, resolve its ingredients through the warm resolver and
+        # render its text report into memory:
+        benchmarks = self
+        client = benchmarks.client
+        resolver = benchmarks.resolver
+        benchmarks.day.evaluate(client, resolver=resolver)
+        ingredients = benchmarks.recipes[0].ingredients
+        def operation():
+            recipe = Recipe("Benchmark Recipe")
+            for ingredient in ingredients:
+                recipe.ingredient(ingredient.amount, ingredient.units, ingredient.description,
+                  food_id=ingredient.food_id, food=ingredient.food)
+            renderer = food.TextRenderer(io.StringIO())
+            recipe.process(client, resolver=resolver, renderer=renderer)
+            renderer.flush()
+        return operation
+
+    def day_process_operation(self):
+        benchmarks = self
+        client = benchmarks.client
+        resolver = benchmarks.resolver
+        day = benchmarks.day
+        day.evaluate(client, resolver=resolver)
+        def operation():
+            renderer = food.TextRenderer(io.StringIO())
+            day.process(client, resolver=resolver, renderer=renderer)
+        return operation
+
+    def day_evaluate_operation(self):
+        benchmarks = self
+        client = benchmarks.client
+        resolver = benchmarks.resolver
+        day = benchmarks.day
+        def operation():
+            day.vector = None
+            day.evaluate(client, resolver=resolver)
+        return operation
+
+    def lookup_resolver_hit_operation(self):
+        benchmarks = self
+        client = benchmarks.client
+        resolver = benchmarks.resolver
+        ingredient = Ingredient(1.0, "slice", "catalog food", food_id=1)
+        ingredient.food_lookup(client, resolver=resolver)
+        def operation():
+            ingredient.food_lookup(client, resolver=resolver)
+        return operation
+
+    def lookup_catalog_hit_operation(self):
+        benchmarks = self
+        client = benchmarks.client
+        catalog = benchmarks.catalog
+        store = benchmarks.store
+        size = benchmarks.size
+        ingredients = [Ingredient(1.0, "slice", "catalog food", food_id=food_id)
+          for food_id in range(1, size + 1)]
+        counter = [0]
+        def operation():
+            counter[0] += 1
+            ingredients[counter[0] % size].food_lookup(client, store=store, catalog=catalog)
+        return operation
+
+    def lookup_store_hit_operation(self):
+        benchmarks = self
+        client = benchmarks.client
+        catalog = benchmarks.catalog
+        store = benchmarks.store
+        size = benchmarks.size
+        ingredients = [Ingredient(1.0, "slice", "store food", food_id=food_id)
+          for food_id in range(size + 1, 2 * size + 1)]
+        counter = [0]
+        def operation():
+            counter[0] += 1
+            ingredients[counter[0] % size].food_lookup(client, store=store, catalog=catalog)
+        return operation
+
+    def lookup_miss_operation(self):
+        # Every lookup is for a food id that has never been seen, so it goes to the (fake)
+        # USDA with its latency and is then written to the store:
+        benchmarks = self
+        client = benchmarks.client
+        catalog = benchmarks.catalog
+        store = benchmarks.store
+        def operation():
+            food_id = benchmarks.miss_id
+            benchmarks.miss_id += 1
+            Ingredient(1.0, "slice", "new food", food_id=food_id).food_lookup(client,
+              store=store, catalog=catalog)
+        return operation
+
+    def scheduled_fetch_operation(self):
+        # Fetch a new food through a *FetchScheduler* over HTTP from a local stand-in USDA
+        # server, with every tenth response a transient error that has to be retried:
+        benchmarks = self
+        benchmarks.server = StandInUsdaServer(latency=benchmarks.latency, failure_rate=0.1)
+        client = StandInUsdaClient(benchmarks.server.uri_get())
+        scheduler = FetchScheduler(client, rate=1e6, burst=1000, backoff=0.001)
+        def operation():
+            food_id = benchmarks.miss_id
+            benchmarks.miss_id += 1
+            scheduler.fetch(food_id)
+        return operation
+
+class FakeUsdaClient(UsdaClient):
+    def __init__(self, latency=0.0, seed=0):
+        # Verify argument types:
+        assert isinstance(latency, float) or isinstance(latency, int)
+
+        # Load up *client* (i.e. *self*).  Every request sleeps for *latency* seconds and
+        # returns a made up food that only depends on the food id and *seed*:
+        UsdaClient.__init__(self, "DEMO_KEY")
+        client = self
+        client.latency  = latency
+        client.seed     = seed
+        client.requests = 0
+
+    def search_foods(self, query, max, **kwargs):
+        client = self
+        client.requests += 1
+        time.sleep(client.latency)
+        yield usda.domain.Food(int(query), "Synthetic Food {0}".format(query))
+
+    def get_food_report(self, ndb_food_id, *args, **kwargs):
+        client = self
+        client.requests += 1
+        time.sleep(client.latency)
+        values = synthetic_nutrients_get(client.seed, ndb_food_id)
+        measures = [usda.domain.Measure(1.0, 240.0, "cup", 0.0),
+          usda.domain.Measure(1.0, 30.0, "slice", 0.0)]
+        nutrients = [usda.domain.Nutrient(index, name, unit=unit, value=float(value),
+          measures=measures) for index, ((name, unit), value) in
+          enumerate(zip(USDA_NUTRIENTS, values))]
+        return usda.domain.FoodReport(usda.domain.Food(int(ndb_food_id), "Synthetic Food"),
+          nutrients, None, None, None)
+
+class StandInUsdaClient(UsdaClient):
+    def __init__(self, base_uri, api_key="DEMO_KEY"):
+        # Verify argument types:
+        assert isinstance(base_uri, str)
+
+        # A real *UsdaClient* (requests, JSON parsing, errors and all) that talks to
+        # *base_uri* (e.g. a *StandInUsdaServer*) rather than to api.nal.usda.gov:
+        UsdaClient.__init__(self, api_key)
+        client = self
+        client.base_uri = base_uri
+
+    def build_uri(self, uri_action):
+        client = self
+        return "".join([client.base_uri, client.uri_part, uri_action.value])
+
+class StandInUsdaServer:
+    def __init__(self, latency=0.0, failure_rate=0.0, rate_limit_every=0, seed=0):
+        # Verify argument types:
+        assert isinstance(latency, float) or isinstance(latency, int)
+        assert isinstance(failure_rate, float) or isinstance(failure_rate, int)
+        assert isinstance(rate_limit_every, int) and rate_limit_every >= 0
+
+        # Serve the two USDA NDB endpoints that *Food.usda_fetch* uses (`ndb/search` and
+        # `ndb/reports`) on a local port from a background thread.  Each response takes
+        # *latency* seconds, a *failure_rate* fraction of them are 503 errors and every
+        # *rate_limit_every*'th one (if not 0) is an OVER_RATE_LIMIT error:
+        server = self
+        server.latency          = latency
+        server.failure_rate     = failure_rate
+        server.rate_limit_every = rate_limit_every
+        server.seed             = seed
+        server.random           = numpy.random.default_rng(seed)
+        server.lock             = threading.Lock()
+        server.requests         = collections.Counter()   # Path => requests (incl. errors)
+        server.errors           = 0
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                server.request_handle(handler)
+            def log_message(handler, format, *arguments):
+                pass
+        server.http_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.http_server.daemon_threads = True
+        server.thread = threading.Thread(target=server.http_server.serve_forever, daemon=True)
+        server.thread.start()
+
+    def uri_get(self):
+        # Return the base URI to hand to *StandInUsdaClient*:
+        server = self
+        host, port = server.http_server.server_address[:2]
+        return "http://{0}:{1}/".format(host, port)
+
+    def close(self):
+        server = self
+        server.http_server.shutdown()
+        server.http_server.server_close()
+
+    def request_handle(self, handler):
+        server = self
+        url = urllib.parse.urlparse(handler.path)
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        with server.lock:
+            server.requests[url.path] += 1
+            count = sum(server.requests.values())
+            failed = server.random.random() < server.failure_rate
+            rate_limited = server.rate_limit_every > 0 and count % server.rate_limit_every == 0
+            if failed or rate_limited:
+                server.errors += 1
+        time.sleep(server.latency)
+
+        status = 200
+        if failed:
+            status, body = 503, b"Service Unavailable"
+        elif rate_limited:
+            body = json.dumps({"error": {"code": "OVER_RATE_LIMIT",
+              "message": "API rate limit exceeded"}}).encode()
+        elif url.path == "/ndb/search":
+            food_id = parameters.get("q", "0")
+            body = json.dumps({"list": {"q": food_id, "start": 0, "end": 1, "total": 1,
+              "item": [{"ndbno": food_id, "name": "Synthetic Food {0}".format(food_id)}]}
+            }).encode()
+        elif url.path == "/ndb/reports":
+            food_id = parameters.get("ndbno", "0")
+            nutrients = [{"nutrient_id": index, "name": name, "group": "Proximates",
+              "unit": unit, "value": float(value), "measures": [
+                {"qty": 1.0, "eqv": 240.0, "label": "cup", "value": float(value) * 2.4},
+                {"qty": 1.0, "eqv": 30.0, "label": "slice", "value": float(value) * 0.3}]}
+              for index, ((name, unit), value) in enumerate(zip(USDA_NUTRIENTS,
+                synthetic_nutrients_get(server.seed, food_id)))]
+            body = json.dumps({"report": {"type": "Basic", "footnotes": [], "food": {
+              "ndbno": food_id, "name": "Synthetic Food {0}".format(food_id),
+              "nutrients": nutrients}}}).encode()
+        else:
+            status, body = 404, b"Not Found"
+        handler.send_response(status)
+        handler.send_header("Content-Type",
+          "application/json" if status == 200 else "text/plain")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+# The benchmark names in the order they are run:
+BENCHMARK_NAMES = (
+  "food_init",
+  "food_add",
+  "food_mul",
+  "recipe_process",
+  "day_process",
+  "day_evaluate",
+  "lookup_resolver_hit",
+  "lookup_catalog_hit",
+  "lookup_store_hit",
+  "lookup_miss",
+  "scheduled_fetch",
+)
+
+# The benchmarks that wait on (fake) network latency:
+SLOW_BENCHMARK_NAMES = ("lookup_miss", "scheduled_fetch")
+
+def measure(operation, seconds=0.5, minimum_count=20, allocation_count=50):
+    # Run *operation* for about *seconds* (and at least *minimum_count* times) and return a
+    # *dict* of its throughput and latency percentiles.  Allocations are measured in a
+    # separate pass of *allocation_count* operations, since *tracemalloc* slows everything:
+    operation()  # Warm up
+    latencies = list()
+    start = time.perf_counter()
+    end = start + seconds
+    while len(latencies) < minimum_count or time.perf_counter() < end:
+        before = time.perf_counter_ns()
+        operation()
+        latencies.append(time.perf_counter_ns() - before)
+    elapsed = time.perf_counter() - start
+    latencies = numpy.array(latencies, dtype=numpy.float64) / 1000.0
+    p50, p90, p99 = numpy.percentile(latencies, [50.0, 90.0, 99.0])
+
+    tracemalloc.start()
+    before_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for index in range(allocation_count):
+        operation()
+    current, peak = tracemalloc.get_traced_memory()
+    after_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    statistics = after_snapshot.compare_to(before_snapshot, "filename")
+    allocated_blocks = sum(max(statistic.count_diff, 0) for statistic in statistics)
+
+    result = {
+      "count":            len(latencies),
+      "ops_per_second":   len(latencies) / elapsed,
+      "p50_us":           float(p50),
+      "p90_us":           float(p90),
+      "p99_us":           float(p99),
+      "peak_bytes":       peak,
+      "retained_blocks":  allocated_blocks / allocation_count,
+    }
+    return result
+
+def run(names=BENCHMARK_NAMES, size=1000, latency=0.001, seconds=0.5, seed=0):
+    # Verify argument types:
+    assert isinstance(names, list) or isinstance(names, tuple)
+
+    # Run the benchmarks in *names* and return the results *dict* that *results_write*()
+    # stores:
+    benchmarks = Benchmarks(size=size, latency=latency, seed=seed)
+    results = dict()
+    try:
+        for name in names:
+            assert name in BENCHMARK_NAMES, "Unknown benchmark '{0}'".format(name)
+            operation = getattr(benchmarks, name + "_operation")()
+            # Slow operations get fewer samples rather than an unbounded run time:
+            results[name] = measure(operation, seconds=seconds,
+              minimum_count=5 if name in SLOW_BENCHMARK_NAMES else 20,
+              allocation_count=5 if name in SLOW_BENCHMARK_NAMES else 50)
+    finally:
+        benchmarks.close()
+    report = {
+      "version":    RESULTS_VERSION,
+      "time":       time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "python":     platform.python_version(),
+      "numpy":      numpy.__version__,
+      "machine":    platform.machine(),
+      "parameters": {"size": size, "latency": latency, "seconds": seconds, "seed": seed},
+      "results":    results,
+    }
+    return report
+
+def results_write(report, path):
+    with open(path, "w") as results_file:
+        json.dump(report, results_file, indent=2, sort_keys=True)
+        results_file.write("\n")
+
+def results_print(report, baseline=None, stream=None):
+    # Print *report*, with the change in throughput relative to *baseline* when given:
+    stream = sys.stdout if stream is None else stream
+    stream.write("{0:<20} {1:>12} {2:>10} {3:>10} {4:>10} {5:>12}{6}\n".format(
+      "benchmark", "ops/sec", "p50 us", "p90 us", "p99 us", "peak bytes",
+      "" if baseline is None else "   vs baseline"))
+    baseline_results = dict() if baseline is None else baseline["results"]
+    for name, result in report["results"].items():
+        change = ""
+        if name in baseline_results:
+            ratio = result["ops_per_second"] / baseline_results[name]["ops_per_second"]
+            change = "   {0:+8.1f}%".format((ratio - 1.0) * 100.0)
+        stream.write("{0:<20} {1:>12.1f} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>12}{6}\n".format(
+          name, result["ops_per_second"], result["p50_us"], result["p90_us"], result["p99_us"],
+          result["peak_bytes"], change))
+
+def main():
+    # Parse `[--size N] [--latency SECONDS] [--seconds SECONDS] [--output FILE]
+    # [--compare FILE] [NAME ...]`:
+    arguments = sys.argv[1:]
+    options = {"--size": "1000", "--latency": "0.001", "--seconds": "0.5", "--output": None,
+      "--compare": None}
+    names = list()
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument in options and index + 1 < len(arguments):
+            options[argument] = arguments[index + 1]
+            index += 2
+        else:
+            names.append(argument)
+            index += 1
+
+    report = run(names or BENCHMARK_NAMES, size=int(options["--size"]),
+      latency=float(options["--latency"]), seconds=float(options["--seconds"]))
+    baseline = None
+    if options["--compare"] is not None:
+        with open(options["--compare"]) as baseline_file:
+            baseline = json.load(baseline_file)
+    results_print(report, baseline)
+    if options["--output"] is not None:
+        results_write(report, options["--output"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())